@@ -0,0 +1,275 @@
+import argparse
+import json
+import os.path
+import shutil
+import subprocess
+import tempfile
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from time import time, perf_counter
+from typing import List, Optional
+
+import numpy as np
+import requests
+from PIL import Image
+from progress.bar import Bar
+
+import extractors
+from crawler import Crawler
+from decoding import LazyImage
+from downloader import Downloader
+from fixtures import load_fixtures, synthetic_faces
+from mock_server import MockServer, MockClient
+from ratelimit import AdaptiveRateLimiter
+from writers import ENCODERS, get_encoder
+
+
+def benchmark_downloads(server: MockServer, images: int, threads: int, downloader: Downloader = None) -> dict:
+    urls = [server.image_url('{}_n'.format(i)) for i in range(images)]
+
+    def fetch(url: str) -> int:
+        if downloader:
+            response = downloader.get(url)
+            chunks = downloader.iter_content(response)
+        else:
+            response = requests.get(url, stream=True)
+            chunks = response.iter_content(1024)
+        with response:
+            return sum(len(chunk) for chunk in chunks)
+
+    thread_pool = ThreadPool(threads)
+    started = time()
+    downloaded = sum(thread_pool.map(fetch, urls))
+    seconds = time() - started
+    thread_pool.close()
+    thread_pool.join()
+    return {'images': images, 'seconds': seconds, 'downloads/s': images / seconds,
+            'MB/s': downloaded / seconds / 2 ** 20}
+
+
+def run_downloads(args: argparse.Namespace) -> dict:
+    server = MockServer(args.latency, 0.0, args.image_size).start()
+    try:
+        downloader = Downloader(connections_per_host=args.threads)
+        return {'requests.get': benchmark_downloads(server, args.images, args.threads),
+                'Downloader': benchmark_downloads(server, args.images, args.threads, downloader)}
+    finally:
+        server.stop()
+
+
+def get_synthetic_crops(images: int, seed: int = 0) -> List[Image.Image]:
+    # eye and mouth sized RGBA crops: smooth skin-like gradient with noise, transparent outside an ellipse
+    random = np.random.RandomState(seed)
+    crops = []
+    for _ in range(images):
+        height, width = random.randint(40, 120), random.randint(80, 240)
+        y, x = np.mgrid[0:height, 0:width]
+        base = random.randint(60, 200, size=3)
+        gradient = (x / width * 40 + y / height * 20)[:, :, None]
+        rgb = np.clip(base + gradient + random.normal(0, 6, (height, width, 3)), 0, 255)
+        inside = ((x - width / 2) / (width / 2)) ** 2 + ((y - height / 2) / (height / 2)) ** 2 <= 1
+        rgba = np.zeros((height, width, 4), dtype=np.uint8)
+        rgba[inside, :3] = rgb[inside]
+        rgba[inside, 3] = 255
+        crops.append(Image.fromarray(rgba))
+    return crops
+
+
+def load_crops(folder: str, images: int) -> List[Image.Image]:
+    filenames = sorted(filename for filename in os.listdir(folder) if filename.endswith('.png'))[:images]
+    crops = []
+    for filename in filenames:
+        with Image.open(os.path.join(folder, filename)) as img:
+            crops.append(img.copy())
+    return crops
+
+
+def encode_all(data: list) -> int:
+    name, level, crops = data
+    encoder = get_encoder(name, level)
+    return sum(len(encoder.encode(crop)) for crop in crops)
+
+
+def benchmark_encoder(name: str, level: int, crops: List[Image.Image], processes: int) -> dict:
+    encoder = get_encoder(name, level)
+    sizes = []
+    started = perf_counter()
+    for crop in crops:
+        sizes.append(len(encoder.encode(crop)))
+    seconds = perf_counter() - started
+
+    # the same work split between worker processes like extraction pool does
+    chunks = [[name, level, crops[i::processes]] for i in range(processes)]
+    with Pool(processes) as pool:
+        started = perf_counter()
+        pool.map(encode_all, chunks)
+        parallel_seconds = perf_counter() - started
+    return {'bytes/image': sum(sizes) / len(sizes), 'encode us': seconds / len(crops) * 1e6,
+            'images/s': len(crops) / seconds, 'parallel images/s': len(crops) / parallel_seconds}
+
+
+def run_encoders(args: argparse.Namespace) -> dict:
+    crops = load_crops(args.folder, args.images) if args.folder else get_synthetic_crops(args.images)
+    formats = args.formats.split(',') if args.formats else list(ENCODERS)
+    return {'{}{}'.format(name, '' if args.level is None else ':{}'.format(args.level)):
+            benchmark_encoder(name, args.level, crops, args.processes) for name in formats}
+
+
+def get_commit() -> Optional[str]:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return commit.decode().strip()
+    except Exception:
+        return None
+
+
+def create_crawler(server: MockServer, process_pool: Pool, args: argparse.Namespace, base_path: str) -> Crawler:
+    # no login, no rate limits and no console output, server latency and errors are the only delays
+    progress_bar = Bar('Benchmark', file=open(os.devnull, 'w'))
+    limiter = partial(AdaptiveRateLimiter, 1e6, burst=args.threads, backoff_base=0.01, backoff_max=0.1)
+    crawler = Crawler('benchmark', '', process_pool, args.processes, args.threads, (0, 0), (0, 0), 0, progress_bar,
+                      batch_size=args.batch_size, downloader=Downloader(args.threads),
+                      feed_limiter=limiter(name='feed'), cdn_limiter=limiter(name='cdn'), encoder=args.encoder,
+                      api=MockClient(server))
+    crawler.base_path = base_path
+    crawler.downloading_stage_printed = True
+    crawler.extractor_stage_printed = True
+    return crawler
+
+
+def benchmark_feed(crawler: Crawler, hashtag: str) -> dict:
+    pages = items = 0
+    max_id = None
+    started = perf_counter()
+    while True:
+        urls, max_id, seen = crawler.get_image_urls(hashtag, max_id)
+        pages += 1
+        items += len(urls) + seen
+        if not max_id:
+            break
+    seconds = perf_counter() - started
+    return {'pages': pages, 'seconds': seconds, 'pages/s': pages / seconds, 'items/s': items / seconds}
+
+
+def benchmark_crawler_downloads(crawler: Crawler, hashtag: str) -> dict:
+    started = perf_counter()
+    crawler.process(hashtag)
+    seconds = perf_counter() - started
+    full_path = crawler.base_path + hashtag + crawler.full_images_path
+    sizes = [os.path.getsize(full_path + filename) for filename in os.listdir(full_path)]
+    return {'images': len(sizes), 'seconds': seconds, 'downloads/s': len(sizes) / seconds,
+            'MB/s': sum(sizes) / seconds / 2 ** 20}
+
+
+def decode_stages(data: list) -> dict:
+    path, detection_size = data
+    started = perf_counter()
+    LazyImage(path).get_array()
+    full = perf_counter() - started
+    started = perf_counter()
+    LazyImage(path).get_draft(detection_size)
+    draft = perf_counter() - started
+    return {'decode': full, 'decode_draft': draft}
+
+
+def benchmark_extraction(crawler: Crawler, hashtag: str, process_pool: Pool, args: argparse.Namespace) -> dict:
+    full_path = crawler.base_path + hashtag + crawler.full_images_path
+    paths = [full_path + filename for filename in os.listdir(full_path)]
+    stage_seconds = {'decode': 0.0, 'decode_draft': 0.0}
+    for timings in process_pool.imap_unordered(decode_stages, [[path, args.detection_size] for path in paths]):
+        for stage, seconds in timings.items():
+            stage_seconds[stage] += seconds
+
+    crawler.stage = 1
+    started = perf_counter()
+    crawler.start_extractor(hashtag)
+    seconds = perf_counter() - started
+    stage_seconds.update(crawler.extract_timings)
+    # stage times are summed over worker processes, images/s is per process
+    return {'images': len(paths), 'faces': crawler.good_extract, 'seconds': seconds, 'images/s': len(paths) / seconds,
+            'stages': {stage: {'ms/image': total / len(paths) * 1000, 'images/s': len(paths) / total if total else None}
+                       for stage, total in stage_seconds.items()}}
+
+
+def run_suite(args: argparse.Namespace) -> dict:
+    images = load_fixtures(args.fixtures) if args.fixtures else synthetic_faces(args.synthetic_images)
+    server = MockServer(args.latency, args.error_rate, images=images, page_size=args.page_size,
+                        pages=args.pages).start()
+    base_path = tempfile.mkdtemp(prefix='benchmark-') + '/'
+    process_pool = Pool(args.processes, initializer=partial(extractors.init_worker, False, args.detection_size))
+    crawler = create_crawler(server, process_pool, args, base_path)
+    try:
+        return {'commit': get_commit(), 'params': vars(args),
+                'feed': benchmark_feed(crawler, 'feed'),
+                'downloads': benchmark_crawler_downloads(crawler, 'makeup'),
+                'extraction': benchmark_extraction(crawler, 'makeup', process_pool, args)}
+    finally:
+        crawler.scheduler.close()
+        crawler.downloader.close()
+        process_pool.close()
+        process_pool.join()
+        server.stop()
+        shutil.rmtree(base_path, ignore_errors=True)
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: dict, results: dict) -> dict:
+    # relative change of every number, params are skipped
+    old, new = flatten(baseline), flatten(results)
+    return {key: (new[key] - old[key]) / old[key] for key in new
+            if not key.startswith(('params.', 'change.')) and old.get(key)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    downloads_parser = subparsers.add_parser('downloads', help='module level requests.get against Downloader')
+    downloads_parser.add_argument('--images', type=int, default=500)
+    downloads_parser.add_argument('--threads', type=int, default=16)
+    downloads_parser.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    downloads_parser.add_argument('--image-size', type=int, default=200 * 1024)
+    encoders_parser = subparsers.add_parser('encoders', help='bytes per image and encode time of crop encoders')
+    encoders_parser.add_argument('--images', type=int, default=500)
+    encoders_parser.add_argument('--folder', help='folder with real png crops, e.g. data/makeup/left_eye')
+    encoders_parser.add_argument('--formats', help='comma separated, all by default')
+    encoders_parser.add_argument('--level', type=int, help='png compression level or webp method')
+    encoders_parser.add_argument('--processes', type=int, default=os.cpu_count())
+    suite_parser = subparsers.add_parser('suite', help='feed, downloads and extraction against mock instagram')
+    suite_parser.add_argument('--pages', type=int, default=10, help='feed pages of every hashtag')
+    suite_parser.add_argument('--page-size', type=int, default=50)
+    suite_parser.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    suite_parser.add_argument('--error-rate', type=float, default=0.0)
+    suite_parser.add_argument('--threads', type=int, default=16)
+    suite_parser.add_argument('--processes', type=int, default=os.cpu_count())
+    suite_parser.add_argument('--batch-size', type=int, default=1)
+    suite_parser.add_argument('--detection-size', type=int, default=640)
+    suite_parser.add_argument('--encoder', default='png')
+    suite_parser.add_argument('--fixtures', help='folder with jpeg photos, synthetic faces are used by default')
+    suite_parser.add_argument('--synthetic-images', type=int, default=16)
+    suite_parser.add_argument('--output', help='write results to json file')
+    suite_parser.add_argument('--compare', help='json results of another commit to compare with')
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        results = run_suite(args)
+        if args.compare:
+            with open(args.compare) as fp:
+                results['change'] = compare(json.load(fp), results)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(results, fp, indent=2)
+        print(json.dumps(results, indent=2))
+    elif args.benchmark == 'downloads':
+        print(json.dumps(run_downloads(args), indent=2))
+    elif args.benchmark == 'encoders':
+        print(json.dumps(run_encoders(args), indent=2))
@@ -0,0 +1,181 @@
+import codecs
+import json
+import os.path
+import uuid
+from threading import Lock
+from time import monotonic
+from typing import List, Tuple, Union
+
+from instagram_private_api import Client, ClientCookieExpiredError, ClientLoginRequiredError
+
+from metrics import get_metrics
+from ratelimit import AdaptiveRateLimiter
+
+
+def to_json(python_object: bytes) -> dict:
+    if isinstance(python_object, bytes):
+        return {'__class__': 'bytes',
+                '__value__': codecs.encode(python_object, 'base64').decode()}
+    raise TypeError(repr(python_object) + ' is not JSON serializable')
+
+
+def from_json(json_object: dict) -> Union[dict, str]:
+    if '__class__' in json_object and json_object['__class__'] == 'bytes':
+        return codecs.decode(json_object['__value__'].encode(), 'base64')
+    return json_object
+
+
+def save_settings(api: Client, settings_file: str) -> None:
+    with open(settings_file, 'w') as outfile:
+        json.dump(api.settings, outfile, default=to_json)
+
+
+def create_client(login: str, password: str, sessions_path: str = 'sessions') -> Client:
+    # the same cached session in sessions/<login>.dat as Crawler uses
+    os.makedirs(sessions_path, exist_ok=True)
+    session_file = os.path.join(sessions_path, login + '.dat')
+    device_id = None
+    try:
+        if not os.path.isfile(session_file):
+            return Client(login, password, on_login=lambda api: save_settings(api, session_file))
+        with open(session_file) as file_data:
+            cached_settings = json.load(file_data, object_hook=from_json)
+        device_id = cached_settings.get('device_id')
+        return Client(login, password, settings=cached_settings)
+    except (ClientCookieExpiredError, ClientLoginRequiredError):
+        return Client(login, password, device_id=device_id, on_login=lambda api: save_settings(api, session_file))
+
+
+class AccountsCoolingDown(Exception):
+    pass
+
+
+class Account:
+    def __init__(self, name: str, client, rate: float = 0.0) -> None:
+        self.name = name
+        self.client = client
+        # every account keeps its own feed rate whatever number of sources is pinned to it
+        self.limiter = AdaptiveRateLimiter(rate, backoff_base=15, backoff_max=300, name='account_' + name) \
+            if rate else None
+        self.throttled_at = 0.0
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.sources = 0
+
+
+class ClientPool:
+    # several accounts behind the Client feed interface, so it is passed to crawlers as api:
+    # every source sticks to one account while it is healthy, new sources and sources of failed accounts go to
+    # the account which was throttled longest ago, failed account is parked for cooldown * 2 ** failures seconds
+    def __init__(self, clients: List[Tuple[str, object]], cooldown: float = 60.0, cooldown_max: float = 900.0,
+                 rate: float = 0.0) -> None:
+        self.accounts = [Account(name, client, rate) for name, client in clients]
+        self.cooldown = cooldown
+        self.cooldown_max = cooldown_max
+        self.assignments = {}
+        self.lock = Lock()
+        # rank token is generated by client, one shared token keeps pagination of a source valid
+        # whatever account requests its next page
+        self.settings = {'uuid': str(uuid.uuid4())}
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def acquire(self, source: str, exclude: tuple = ()) -> Account:
+        with self.lock:
+            now = monotonic()
+            account = self.assignments.get(source)
+            if account and account.cooldown_until <= now and account not in exclude:
+                return account
+            available = [account for account in self.accounts
+                         if account.cooldown_until <= now and account not in exclude]
+            if not available:
+                raise AccountsCoolingDown('All {} accounts are on cooldown'.format(len(self.accounts)))
+            new_account = min(available, key=lambda candidate: (candidate.throttled_at, candidate.sources))
+            if account:
+                account.sources -= 1
+            new_account.sources += 1
+            self.assignments[source] = new_account
+            return new_account
+
+    def success(self, account: Account) -> None:
+        with self.lock:
+            account.failures = 0
+
+    def failure(self, account: Account) -> None:
+        with self.lock:
+            now = monotonic()
+            account.throttled_at = now
+            account.cooldown_until = now + min(self.cooldown_max, self.cooldown * 2 ** account.failures)
+            account.failures += 1
+
+    def call(self, source: str, method: str, *args, **kwargs):
+        # failed request is retried on every other available account before error is raised to crawler backoff
+        tried = []
+        last_error = None
+        while True:
+            try:
+                account = self.acquire(source, tuple(tried))
+            except AccountsCoolingDown as e:
+                if last_error:
+                    raise e from last_error
+                raise
+            if account.limiter:
+                account.limiter.acquire()
+            get_metrics().inc('account_requests_total', account=account.name)
+            try:
+                result = getattr(account.client, method)(*args, **kwargs)
+            except Exception as e:
+                get_metrics().inc('account_errors_total', account=account.name)
+                if account.limiter:
+                    account.limiter.throttled()
+                self.failure(account)
+                tried.append(account)
+                last_error = e
+                continue
+            if account.limiter:
+                account.limiter.success()
+            self.success(account)
+            return result
+
+    def feed_tag(self, tag: str, rank_token: str, **kwargs) -> dict:
+        return self.call(tag, 'feed_tag', tag, rank_token, **kwargs)
+
+    def username_feed(self, user_name: str, **kwargs) -> dict:
+        return self.call(user_name, 'username_feed', user_name, **kwargs)
+
+
+def create_client_pool(accounts: List[Tuple[str, str]], cooldown: float = 60.0,
+                       sessions_path: str = 'sessions', rate: float = 0.0) -> ClientPool:
+    return ClientPool([(login, create_client(login, password, sessions_path)) for login, password in accounts],
+                      cooldown, rate=rate)
+
+
+class StubClient:
+    # in-memory stand-in for Client, fails every `fail_every` request like a rate limited account
+    def __init__(self, name: str = 'stub', page_size: int = 10, pages: int = 10, fail_every: int = 0) -> None:
+        self.name = name
+        self.page_size = page_size
+        self.pages = pages
+        self.fail_every = fail_every
+        self.requests = 0
+        self.settings = {'uuid': name}
+
+    def get_feed(self, source: str, max_id: str = None) -> dict:
+        self.requests += 1
+        if self.fail_every and self.requests % self.fail_every == 0:
+            raise Exception('{} is throttled'.format(self.name))
+        page = int(max_id) if max_id else 0
+        items = [{'id': '{}_{}_{}'.format(source, page, i), 'code': '{}_{}_{}'.format(source, page, i),
+                  'media_type': 1, 'image_versions2': {'candidates': [
+                      {'url': 'http://127.0.0.1/cdn/{}_{}_{}_n.jpg'.format(source, page, i)}]}}
+                 for i in range(self.page_size)]
+        more_available = page + 1 < self.pages
+        return {'items': items, 'more_available': more_available,
+                'next_max_id': str(page + 1) if more_available else None, 'account': self.name}
+
+    def feed_tag(self, tag: str, rank_token: str, **kwargs) -> dict:
+        return self.get_feed(tag, kwargs.get('max_id'))
+
+    def username_feed(self, user_name: str, **kwargs) -> dict:
+        return self.get_feed(user_name, kwargs.get('max_id'))
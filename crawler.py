@@ -1,19 +1,29 @@
 from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
-from random import randint
+from queue import Queue, Empty, Full
+from threading import Thread, BoundedSemaphore, Lock
 import pynput
 from instagram_private_api import Client, ClientCookieExpiredError, ClientLoginRequiredError
 import ssl
 import json
 import codecs
 import os.path
-import requests
 import re
 from progress.bar import Bar
 from typing import Optional, Union, List, Tuple
 import extractors
-from PIL import Image
-from time import sleep
+from dedup import DedupIndex
+from cursors import CursorStore
+from download_log import open_download_log
+from pagination import FeedPrefetcher, download_pages
+from ratelimit import AdaptiveRateLimiter
+from scheduler import DownloadScheduler
+from downloader import Downloader
+from manifest import ExtractionManifest
+from phash import HashIndex, dhash
+from metrics import get_metrics
+from writers import FolderWriter, open_writer, encode_images, get_encoder
+from decoding import LazyImage, IMAGE_EXTENSIONS, sniff_file, with_true_extension
+from time import time, perf_counter
 
 
 class Crawler:
@@ -45,28 +55,41 @@ class Crawler:
 
     def __init__(self, login: str, password: str, process_pool: Pool, processes: int,
                  threads: int, delay_before: tuple, delay_error: tuple, uniq_type: int, progress_bar: Bar,
-                 extractor_stage: int = False, images_number: int = None) -> None:
+                 extractor_stage: int = False, images_number: int = None, batch_size: int = 1,
+                 save_in_workers: bool = False, pipeline: bool = False, pipeline_queue_size: int = 0,
+                 incremental: bool = False, manifest_hash: bool = False,
+                 downloader: Downloader = None, prefetch_depth: int = 1, download_log: str = 'text',
+                 fsync_every: int = 0, compact_log: bool = False, cursor_mode: str = 'none',
+                 feed_limiter: AdaptiveRateLimiter = None, cdn_limiter: AdaptiveRateLimiter = None,
+                 max_retries: int = 5, skip_near_duplicates: bool = False, phash_distance: int = 4,
+                 scheduler: DownloadScheduler = None, min_image_side: int = 0,
+                 true_extension: bool = False, output: str = 'folders', shard_size: int = 256 * 1024 * 1024,
+                 encoder: str = 'png', encoder_level: int = None, api: Client = None,
+                 node_id: str = '') -> None:
         self.listener = pynput.keyboard.Listener(on_press=self.on_press)
         ssl._create_default_https_context = ssl._create_unverified_context
         device_id = None
 
+        # api is passed by benchmarks with mock feed, otherwise logged in client is created
+        self.api = api
         try:
-            os.makedirs('sessions', exist_ok=True)
-            session_file = 'sessions/' + login + '.dat'
-            if not os.path.isfile(session_file):
-                self.api = Client(login, password, on_login=lambda x: self.on_login(x, session_file))
-            else:
-                with open(session_file) as file_data:
-                    cached_settings = json.load(file_data, object_hook=Crawler.from_json)
-                device_id = cached_settings.get('device_id')
-                self.api = Client(login, password, settings=cached_settings)
+            if self.api is None:
+                os.makedirs('sessions', exist_ok=True)
+                session_file = 'sessions/' + login + '.dat'
+                if not os.path.isfile(session_file):
+                    self.api = Client(login, password, on_login=lambda x: self.on_login(x, session_file))
+                else:
+                    with open(session_file) as file_data:
+                        cached_settings = json.load(file_data, object_hook=Crawler.from_json)
+                    device_id = cached_settings.get('device_id')
+                    self.api = Client(login, password, settings=cached_settings)
 
         except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
             self.api = Client(login, password, device_id=device_id, on_login=lambda x: self.on_login(session_file))
 
         self.process_pool = process_pool
         # self.thread_pool = thread_pool
-        self.images = {}
+        self.dedup = DedupIndex(uniq_type)
         self.extractor_stage = extractor_stage
         self.extractor_stage_printed = False
         self.downloading_stage_printed = False
@@ -78,13 +101,68 @@ class Crawler:
         if self.extractor_stage:
             self.stage = 1
         self.good_extract = 0
+        self.detection_stats = {'images': 0, 'scale': 0.0, 'downscaled': 0, 'fallbacks': 0, 'fallback_faces': 0}
         self.processes = processes
         self.threads = threads
         self.images_number = images_number
+        self.batch_size = batch_size
+        self.save_in_workers = save_in_workers
+        self.extract_timings = {'extract': 0.0, 'save': 0.0}
+        # pipeline mode sends every downloaded file straight to extraction through bounded queue
+        self.pipeline = pipeline
+        self.pipeline_queue_size = pipeline_queue_size if pipeline_queue_size else processes * 4
+        self.extract_queues = {}
+        # incremental mode skips images already recorded in data/<hashtag>/extracted.jsonl
+        self.incremental = incremental
+        self.manifest_hash = manifest_hash
+        self.manifests = {}
+        # manifests are opened by extractor threads of all hashtags
+        self.manifests_lock = Lock()
         self.rank_token = self.api.settings.get('uuid')
         self.post_codes = []
         self.image_ids = []
         self.progress_bar = progress_bar
+        self.downloader = downloader if downloader else Downloader()
+        self.prefetch_depth = prefetch_depth
+        self.download_log = download_log
+        self.fsync_every = fsync_every
+        self.compact_log = compact_log
+        self.cursor_mode = cursor_mode
+        # limiters are shared by all threads, default cdn rate is the same as with delay_before sleeps
+        self.feed_limiter = feed_limiter if feed_limiter else AdaptiveRateLimiter(0.5, backoff_base=15,
+                                                                                 backoff_max=300, name='feed')
+        self.cdn_limiter = cdn_limiter if cdn_limiter else AdaptiveRateLimiter(
+            threads * 2000 / max(sum(delay_before), 1), backoff_base=sum(delay_error) / 2000, name='cdn')
+        self.max_retries = max_retries
+        # all sources share one scheduler, so there are `threads` downloads at most whatever number of sources
+        self.scheduler = scheduler if scheduler else DownloadScheduler(threads)
+        # images downloaded or being downloaded per source, counted while IMAGES_NUMBER is set
+        self.downloaded = {}
+        self.quota_lock = Lock()
+        self.active_sources = set()
+        # sources whose work queue lease was taken over by another node, they stop like on q
+        self.lost_sources = set()
+        # 0 downloads the largest candidate
+        self.min_image_side = min_image_side
+        # downloads are saved as .png by default whatever CDN returns
+        self.true_extension = true_extension
+        # near duplicates by perceptual hash are skipped before extraction, index is shared by all hashtags
+        self.skip_near_duplicates = skip_near_duplicates
+        self.phash_distance = phash_distance
+        self.hash_index = None
+        self.hash_index_lock = Lock()
+        self.near_duplicates = 0
+        # output is "folders" with a png per crop or "shards" with tar shards in data/<hashtag>/shards/
+        self.output = output
+        self.shard_size = shard_size
+        # nodes of a distributed run write own shards and manifests into shared hashtag folders
+        self.node_id = node_id
+        self.writers = {}
+        self.writers_lock = Lock()
+        # detection stats, timings and counters are updated by extractor threads of all hashtags
+        self.stats_lock = Lock()
+        # crops are encoded as png, lossless webp or raw BGRA npy in extraction workers
+        self.encoder = get_encoder(encoder, encoder_level)
 
     @staticmethod
     def on_login(api: Client, new_settings_file: str) -> None:
@@ -111,29 +189,48 @@ class Crawler:
             'image_versions2') and 'url' in \
                image.get('image_versions2').get('candidates')[0]
 
-    def get_image_urls(self, hashtag: str, max_id: str = None) -> Tuple[list, str]:
+    @staticmethod
+    def select_candidate(candidates: list, min_side: int = 0) -> dict:
+        # the smallest candidate with shorter side not less than min_side, candidates[0] is the largest
+        if not min_side:
+            return candidates[0]
+        suitable = [candidate for candidate in candidates
+                    if 'url' in candidate and min(candidate.get('width', 0), candidate.get('height', 0)) >= min_side]
+        if not suitable:
+            return candidates[0]
+        return min(suitable, key=lambda candidate: candidate.get('width', 0) * candidate.get('height', 0))
+
+    def get_image_urls(self, hashtag: str, max_id: str = None) -> Tuple[list, str, int]:
         result = []
+        seen = 0
         next_max_id = ''
         data = None
+        attempt = 0
         while data is None:
             if self.terminate or self.stage != 0:
-                return [], ''
+                return [], '', 0
             if self.images_number and self.progress_bar.index >= self.images_number:
                 self.stage = 1
             try:
-                if max_id:
-                    data = self.api.feed_tag(hashtag, self.rank_token, max_id=max_id)
-                else:
-                    data = self.api.feed_tag(hashtag, self.rank_token)
+                self.feed_limiter.acquire()
+                with get_metrics().timer('feed_request_seconds'):
+                    if max_id:
+                        data = self.api.feed_tag(hashtag, self.rank_token, max_id=max_id)
+                    else:
+                        data = self.api.feed_tag(hashtag, self.rank_token)
+                self.feed_limiter.success()
             except Exception:
-                sleep(randint(15, 60))
+                get_metrics().inc('feed_errors_total')
+                self.feed_limiter.throttled()
+                self.feed_limiter.backoff(attempt)
+                attempt += 1
         if 'items' in data:
             if 'more_available' in data and data.get('more_available') and 'next_max_id' in data:
                 next_max_id = data.get('next_max_id')
 
             for e in data.get('items'):
                 if self.terminate or self.stage != 0:
-                    return [], ''
+                    return [], '', 0
                 if self.images_number and self.progress_bar.index >= self.images_number:
                     self.stage = 1
                 if not ('media_type' in e and 'code' in e and 'id' in e):
@@ -143,12 +240,16 @@ class Crawler:
                 if media_type == 1:
                     if not Crawler.check_image_fields(e):
                         continue
-                    image_url = e.get('image_versions2').get('candidates')[0].get('url')
-                    filename = self.get_id_from_url(image_url)
-                    if not self.is_filename_uniq(filename, hashtag, self.uniq_type):
+                    candidates = e.get('image_versions2').get('candidates')
+                    # dedup is keyed on the largest rendition whatever candidate is downloaded
+                    filename = self.get_id_from_url(candidates[0].get('url'))
+                    image_url = Crawler.select_candidate(candidates, self.min_image_side).get('url')
+                    if not self.dedup.claim(filename, hashtag):
+                        # top-up stops on images of this source only, not on ones of other sources with UNIQ_TYPE=1
+                        if self.dedup.is_claimed(filename, hashtag):
+                            seen += 1
                         continue
-                    self.images[hashtag] += [filename]
-                    result += [image_url]
+                    result += [[image_url, filename]]
 
                 elif media_type == 8:
                     if 'carousel_media' not in e:
@@ -158,23 +259,21 @@ class Crawler:
                             continue
                         if ce.get('media_type') != 1 or not Crawler.check_image_fields(ce):
                             continue
-                        image_url = ce.get('image_versions2').get('candidates')[0].get('url')
-                        filename = self.get_id_from_url(image_url)
-                        if not self.is_filename_uniq(filename, hashtag, self.uniq_type):
+                        candidates = ce.get('image_versions2').get('candidates')
+                        # dedup is keyed on the largest rendition whatever candidate is downloaded
+                        filename = self.get_id_from_url(candidates[0].get('url'))
+                        image_url = Crawler.select_candidate(candidates, self.min_image_side).get('url')
+                        if not self.dedup.claim(filename, hashtag):
+                            # top-up stops on images of this source only, not on ones of other sources with UNIQ_TYPE=1
+                            if self.dedup.is_claimed(filename, hashtag):
+                                seen += 1
                             continue
-                        self.images[hashtag] += [filename]
-                        result += [image_url]
-        return result, next_max_id
-
-    def is_filename_uniq(self, filename: str, hashtag: str, uniq_type: int = 0) -> bool:
-        if uniq_type == 0:
-            return filename not in self.images[hashtag]
-        if uniq_type == 1:
-            images = []
-            for _, value in self.images.items():
-                images += value
-            return filename not in images
-        return True
+                        result += [[image_url, filename]]
+        # dedup hit rate is seen / (new + seen)
+        get_metrics().inc('feed_pages_total')
+        get_metrics().inc('feed_items_total', len(result), result='new')
+        get_metrics().inc('feed_items_total', seen, result='seen')
+        return result, next_max_id, seen
 
     def process(self, hashtag: str) -> None:
         for folder in self.folders:
@@ -187,33 +286,138 @@ class Crawler:
         if not self.downloading_stage_printed:
             self.downloading_stage_print()
 
-        self.images[hashtag] = []
-        if os.path.isfile(self.base_path + hashtag + '/downloaded_images.txt'):
-            with open(self.base_path + hashtag + '/downloaded_images.txt', 'r') as fp:
-                self.images[hashtag] = fp.read().split('\n')
-        next_max_id = None
-        fp = open(self.base_path + hashtag + '/downloaded_images.txt', 'w')
-        fp.write('\n'.join(self.images[hashtag]))
-        thread_pool = ThreadPool(self.threads)
-        while (not self.terminate) and next_max_id != '' and self.stage == 0:
-            res = thread_pool.apply_async(self.get_image_urls, (hashtag, next_max_id))
-            urls, next_max_id = res.get()
-            urls = [[hashtag, url] for url in urls]
-            results = thread_pool.imap_unordered(self.save_from_url, urls)
-            for result in results:
-                if result:
-                    fp.write(result + '\n')
-                    if self.stage == 0:
-                        self.progress_bar.next()
-        fp.close()
+        download_log = open_download_log(self.base_path + hashtag, self.download_log, self.fsync_every)
+        if self.compact_log:
+            download_log.compact(self.base_path + hashtag + self.full_images_path)
+        self.dedup.add(hashtag, download_log.load())
+        pipeline_thread = None
+        if self.pipeline:
+            self.extract_queues[hashtag] = Queue(self.pipeline_queue_size)
+            pipeline_thread = Thread(target=self.pipeline_extractor, args=(hashtag,))
+            pipeline_thread.start()
+        thread_pool = self.scheduler.source(hashtag)
+        self.downloaded.setdefault(hashtag, 0)
+        self.active_sources.add(hashtag)
+
+        def on_result(result: Optional[str]) -> None:
+            if result:
+                download_log.append(result)
+                if self.stage == 0:
+                    self.progress_bar.next()
+
+        def on_page_done(next_max_id: str) -> None:
+            # images of stopped crawl are not downloaded, so their pages are not checkpointed
+            if not self.is_source_stopped(hashtag):
+                cursor.save(next_max_id)
+
+        cursor = CursorStore(self.base_path + hashtag + '/cursor.json')
+        prefetcher = FeedPrefetcher(lambda max_id: self.get_image_urls(hashtag, max_id), self.prefetch_depth,
+                                    lambda: self.is_source_stopped(hashtag), cursor, self.cursor_mode).start()
+        pages = (([[hashtag, url, filename] for url, filename in urls], next_max_id)
+                 for urls, next_max_id in prefetcher)
+        download_pages(thread_pool, pages, self.save_from_url, on_result, self.threads, on_page_done)
+        self.active_sources.discard(hashtag)
+        download_log.close()
+        if pipeline_thread:
+            # downloaded files are already extracted, wait for the rest of the queue
+            self.put_to_extract_queue(hashtag, None)
+            pipeline_thread.join()
+            return
         if self.stage == 1:
             return self.start_extractor(hashtag)
 
+    def put_to_extract_queue(self, hashtag: str, path: Optional[str]) -> None:
+        # blocks downloading threads when extraction falls behind
+        while True:
+            try:
+                self.extract_queues[hashtag].put(path, timeout=1)
+                return
+            except Full:
+                if self.terminate:
+                    return
+
+    def pipeline_extractor(self, hashtag: str) -> None:
+        try:
+            self.run_pipeline_extractor(hashtag)
+        finally:
+            self.close_writer(hashtag)
+
+    def run_pipeline_extractor(self, hashtag: str) -> None:
+        paths = self.extract_queues[hashtag]
+        output_path = self.get_worker_output_path(hashtag)
+        in_flight_max = self.processes * 2
+        in_flight = BoundedSemaphore(in_flight_max)
+        # pool has one thread for all callbacks, it only queues results and saving is done by thread of hashtag
+        results = Queue()
+        saver = Thread(target=self.save_extract_results, args=(hashtag, results))
+        saver.start()
+
+        def on_result(task_results: Union[tuple, dict, list]) -> None:
+            try:
+                for result in (task_results if isinstance(task_results, list) else [task_results]):
+                    results.put(result)
+            finally:
+                in_flight.release()
+
+        def on_error(_: BaseException) -> None:
+            in_flight.release()
+
+        try:
+            done = False
+            while not done and not self.terminate:
+                path = paths.get()
+                if path is None:
+                    break
+                batch = [path]
+                while len(batch) < self.batch_size:
+                    try:
+                        path = paths.get(timeout=1)
+                    except Empty:
+                        break
+                    if path is None:
+                        done = True
+                        break
+                    batch.append(path)
+                if self.skip_near_duplicates:
+                    batch = [path for path in batch if not self.is_near_duplicate(hashtag, path)]
+                    if not batch:
+                        continue
+
+                if self.batch_size > 1:
+                    task, args = extract_batch_and_save, [batch, output_path, self.encoder]
+                else:
+                    task, args = extract_and_save, [batch[0], output_path, self.encoder]
+                in_flight.acquire()
+                try:
+                    self.process_pool.apply_async(task, (args,), callback=on_result, error_callback=on_error)
+                except ValueError:
+                    # process pool is closed after q was pressed
+                    in_flight.release()
+                    return
+
+            for _ in range(in_flight_max):
+                in_flight.acquire()
+        finally:
+            results.put(None)
+            saver.join()
+
+    def save_extract_results(self, hashtag: str, results: Queue) -> None:
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            try:
+                self.handle_extract_result(hashtag, result, progress=False)
+            except Exception:
+                # one broken result does not stop saving of the rest, it is counted as an error
+                get_metrics().inc('extract_outcomes_total', outcome='error')
+
     def on_press(self, key) -> Optional[bool]:
         try:
             if key is None or key.char == 'q':
                 print('\nStopping...')
                 self.terminate = True
+                self.scheduler.terminate()
                 self.process_pool.close()
                 self.process_pool.join()
                 return False
@@ -245,75 +449,391 @@ class Crawler:
         self.progress_bar.next(-1)
 
     def save_from_url(self, data: List[str]) -> Optional[str]:
-        hashtag, url = data
-        filename = self.get_id_from_url(url)
+        hashtag, url, filename = data
         response = None
-        if self.terminate or self.stage != 0:
+        if self.is_source_stopped(hashtag):
+            self.dedup.release(filename, hashtag)
             return
         if self.images_number and self.progress_bar.index >= self.images_number:
+            self.dedup.release(filename, hashtag)
             self.stage = 1
             self.extractor_stage_print()
             return
+        if not self.reserve_quota(hashtag):
+            self.dedup.release(filename, hashtag)
+            return
+        started = perf_counter()
+        size = 0
         with open(self.base_path + hashtag + self.full_images_path + filename, 'wb') as handle:
-            while not response:
+            attempt = 0
+            while response is None:
+                if self.terminate:
+                    self.cancel_download(hashtag, filename)
+                    return
                 try:
-                    sleep(randint(*self.delay_before) / 1000)
-                    response = requests.get(url, stream=True)
+                    self.cdn_limiter.acquire()
+                    response = self.downloader.get(url)
                 except Exception:
-                    sleep(randint(*self.delay_error) / 1000)
-            if not response.ok:
-                return
-            for block in response.iter_content(1024):
-                if self.terminate or self.stage != 0:
-                    os.remove(self.base_path + hashtag + self.full_images_path + filename)
-                    return
-                if self.images_number and self.progress_bar.index >= self.images_number:
-                    os.remove(self.base_path + hashtag + self.full_images_path + filename)
-                    self.stage = 1
-                    self.extractor_stage_print()
+                    self.cdn_limiter.report(None)
+                    if attempt >= self.max_retries:
+                        self.cancel_download(hashtag, filename)
+                        return
+                    self.cdn_limiter.backoff(attempt)
+                    attempt += 1
+                    continue
+                # 429 and 5xx are retried with backoff, other errors are not
+                if self.cdn_limiter.report(response.status_code) and attempt < self.max_retries:
+                    response.close()
+                    response = None
+                    self.cdn_limiter.backoff(attempt)
+                    attempt += 1
+            # closing response returns connection to the pool
+            with response:
+                if not response.ok:
+                    get_metrics().inc('download_errors_total')
+                    self.cancel_download(hashtag, filename)
                     return
-                if not block:
-                    break
-                handle.write(block)
+                for block in self.downloader.iter_content(response):
+                    if self.terminate or self.stage != 0:
+                        self.cancel_download(hashtag, filename)
+                        return
+                    if self.images_number and self.progress_bar.index >= self.images_number:
+                        self.cancel_download(hashtag, filename)
+                        self.stage = 1
+                        self.extractor_stage_print()
+                        return
+                    if not block:
+                        break
+                    handle.write(block)
+                    size += len(block)
+        get_metrics().observe('download_seconds', perf_counter() - started)
+        get_metrics().inc('downloads_total')
+        get_metrics().inc('download_bytes_total', size)
+        path = self.base_path + hashtag + self.full_images_path + filename
+        if self.true_extension:
+            # log and dedup keep .png name, so the setting can be switched between runs
+            true_path = with_true_extension(path, sniff_file(path))
+            os.replace(path, true_path)
+            path = true_path
+        if self.pipeline:
+            self.put_to_extract_queue(hashtag, path)
         return filename
 
+    def set_sources(self, sources: List[str]) -> None:
+        # all sources of the run share IMAGES_NUMBER from the start, so the first started source
+        # does not take the whole quota before the others are registered
+        self.active_sources.update(sources)
+
+    def is_over_quota(self, hashtag: str) -> bool:
+        # IMAGES_NUMBER is shared equally between sources which are still downloading
+        if not self.images_number or not self.active_sources:
+            return False
+        quota = -(-self.images_number // len(self.active_sources))
+        return self.downloaded.get(hashtag, 0) >= quota
+
+    def reserve_quota(self, hashtag: str) -> bool:
+        # a download takes its place in IMAGES_NUMBER before it starts and gives it back when cancelled,
+        # so downloads in flight never take a source or the whole run over the budget
+        if not self.images_number:
+            return True
+        with self.quota_lock:
+            if self.is_over_quota(hashtag) or sum(self.downloaded.values()) >= self.images_number:
+                return False
+            self.downloaded[hashtag] = self.downloaded.get(hashtag, 0) + 1
+            return True
+
+    def release_quota(self, hashtag: str) -> None:
+        if not self.images_number:
+            return
+        with self.quota_lock:
+            self.downloaded[hashtag] -= 1
+
+    def is_source_stopped(self, hashtag: str) -> bool:
+        return (self.terminate or self.stage != 0 or self.is_over_quota(hashtag)
+                or hashtag in self.lost_sources)
+
+    def cancel_download(self, hashtag: str, filename: str) -> None:
+        # removes partial file and gives the claim back, so the image is not lost for next runs
+        os.remove(self.base_path + hashtag + self.full_images_path + filename)
+        self.dedup.release(filename, hashtag)
+        self.release_quota(hashtag)
+
     def get_id_from_url(self, url: str) -> str:
         return re.search(r'[\w-]+\.jpg', url).group(0).replace('.jpg', '.png')
 
     def start_extractor(self, hashtag: str) -> None:
-        paths = []
-        for filename in os.listdir(self.base_path + hashtag + self.full_images_path):
-            if not filename.endswith('.png'):
-                continue
-            paths += [self.base_path + hashtag + self.full_images_path + filename]
+        try:
+            self.run_extractor(hashtag)
+        finally:
+            self.close_writer(hashtag)
+
+    def run_extractor(self, hashtag: str) -> None:
+        self.extract_paths(hashtag, list_images(self.base_path + hashtag + self.full_images_path))
+
+    def extract_paths(self, hashtag: str, paths: List[str]) -> None:
+        # writer is left open, it is closed by caller after the last batch of hashtag
+        if self.incremental:
+            manifest = self.get_manifest(hashtag)
+            paths = [path for path in paths if not manifest.is_processed(path)]
+        if self.skip_near_duplicates:
+            paths = self.filter_near_duplicates(hashtag, paths)
 
         if not self.extractor_stage_printed:
             self.extractor_stage_print(len(paths))
 
-        # for extract_batch in range(0, len(paths), self.processes):
-        results = self.process_pool.imap_unordered(extract, paths)
+        output_path = self.get_worker_output_path(hashtag)
+        if self.batch_size > 1:
+            batches = [paths[i:i + self.batch_size] for i in range(0, len(paths), self.batch_size)]
+            tasks = self.process_pool.imap_unordered(extract_batch_and_save,
+                                                     [[batch, output_path, self.encoder] for batch in batches])
+            results = (result for batch in tasks for result in batch)
+        else:
+            results = self.process_pool.imap_unordered(extract_and_save,
+                                                       [[path, output_path, self.encoder] for path in paths])
         for result in results:
-            if self.terminate:
+            if self.terminate or hashtag in self.lost_sources:
                 return
-            path, images = result
-            self.progress_bar.next()
-            if not images:
-                continue
-            for i in range(len(images)):
-                image_filename = path.split('/')[-1]
-                images[i].save(self.base_path + hashtag + self.folders[i] + image_filename)
-            self.good_extract += 1
-
-
-def extract(path: str) -> Tuple[str, list]:
-    img = Image.open(path)
+            self.handle_extract_result(hashtag, result)
+
+    def get_worker_output_path(self, hashtag: str) -> Optional[str]:
+        # workers always encode, with SAVE_IN_WORKERS they also write folders themselves,
+        # otherwise encoded images are passed to the writer here
+        if self.output == 'folders' and self.save_in_workers:
+            return self.base_path + hashtag
+        return None
+
+    def get_writer(self, hashtag: str):
+        with self.writers_lock:
+            if hashtag not in self.writers:
+                self.writers[hashtag] = open_writer(self.output, self.base_path + hashtag, self.folders,
+                                                    self.shard_size, self.encoder,
+                                                    self.node_id + '-' if self.node_id else '')
+            return self.writers[hashtag]
+
+    def close_writer(self, hashtag: str) -> None:
+        with self.writers_lock:
+            writer = self.writers.pop(hashtag, None)
+        if writer:
+            writer.close()
+
+    def close_writers(self) -> None:
+        for hashtag in list(self.writers):
+            self.close_writer(hashtag)
+
+    def get_hash_index(self) -> HashIndex:
+        with self.hash_index_lock:
+            if self.hash_index is None:
+                os.makedirs(self.base_path, exist_ok=True)
+                # every node appends to its own index and reads indexes of all nodes
+                if self.node_id:
+                    self.hash_index = HashIndex(self.base_path + 'phash_index-{}.txt'.format(self.node_id),
+                                                self.phash_distance, shared=self.base_path + 'phash_index*.txt')
+                else:
+                    self.hash_index = HashIndex(self.base_path + 'phash_index.txt', self.phash_distance)
+            return self.hash_index
+
+    def filter_near_duplicates(self, hashtag: str, paths: List[str]) -> List[str]:
+        # first copies already in the index are kept without hashing, the rest is hashed in process pool
+        index = self.get_hash_index()
+        unique = [path for path in paths if path[len(self.base_path):] in index]
+        new_paths = [path for path in paths if path[len(self.base_path):] not in index]
+        for path, image_hash in self.process_pool.imap_unordered(compute_hash, new_paths, chunksize=16):
+            if self.terminate:
+                break
+            if not self.is_near_duplicate(hashtag, path, image_hash):
+                unique.append(path)
+        return unique
+
+    def is_near_duplicate(self, hashtag: str, path: str, image_hash: Optional[int] = None) -> bool:
+        name = path[len(self.base_path):]
+        index = self.get_hash_index()
+        if name in index:
+            return False
+        if image_hash is None:
+            image_hash = compute_hash(path)[1]
+        if image_hash is None:
+            return False
+        if index.check_and_add(image_hash, name) is None:
+            return False
+        self.near_duplicates += 1
+        get_metrics().inc('near_duplicates_total')
+        if self.incremental:
+            self.get_manifest(hashtag).add(path, 'duplicate')
+        return True
+
+    def get_manifest(self, hashtag: str) -> ExtractionManifest:
+        with self.manifests_lock:
+            if hashtag not in self.manifests:
+                # appends over network file systems are not atomic, so every node appends to its own file
+                # and reads files of all nodes, own file is read last
+                folder = self.base_path + hashtag
+                filename = 'extracted-{}.jsonl'.format(self.node_id) if self.node_id else 'extracted.jsonl'
+                read_paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                              if name.startswith('extracted') and name.endswith('.jsonl') and name != filename]
+                path = os.path.join(folder, filename)
+                self.manifests[hashtag] = ExtractionManifest(path, extractors.EXTRACTOR_VERSION, self.manifest_hash,
+                                                             read_paths + [path])
+            return self.manifests[hashtag]
+
+    @staticmethod
+    def get_outcome(success: bool, detection: dict) -> str:
+        if success:
+            return 'ok'
+        if detection and not detection.get('found'):
+            return 'no_face'
+        return 'error'
+
+    def handle_extract_result(self, hashtag: str, result: Union[tuple, dict], progress: bool = True) -> None:
+        # workers either return saved result record or extracted images to save here,
+        # saving is not locked, so pipelines of different hashtags save in parallel
+        if isinstance(result, dict):
+            get_metrics().merge(result.get('metrics'))
+            path, detection, success = result['path'], result['detection'], result['success']
+            timings, data = result['timings'], result.get('encoded')
+        else:
+            path, data, detection = result
+            timings, success = {}, bool(data)
+        if data:
+            started = time()
+            try:
+                with get_metrics().timer('stage_seconds', stage='save'):
+                    self.get_writer(hashtag).write(get_sample_key(path), data)
+            except Exception:
+                success = False
+            timings['save'] = timings.get('save', 0) + time() - started
+        outcome = self.get_outcome(success, detection)
+        get_metrics().inc('extract_outcomes_total', outcome=outcome)
+        if self.incremental:
+            self.get_manifest(hashtag).add(path, outcome)
+        with self.stats_lock:
+            self.update_detection_stats(detection)
+            for stage, seconds in timings.items():
+                self.extract_timings[stage] += seconds
+            if progress:
+                self.progress_bar.next()
+            if success:
+                self.good_extract += 1
+
+    def update_detection_stats(self, detection: dict) -> None:
+        if not detection:
+            return
+        self.detection_stats['images'] += 1
+        self.detection_stats['scale'] += detection['scale']
+        if detection['scale'] < 1:
+            self.detection_stats['downscaled'] += 1
+        if detection['fallback']:
+            self.detection_stats['fallbacks'] += 1
+            if detection['found']:
+                self.detection_stats['fallback_faces'] += 1
+
+    def detection_report(self) -> str:
+        stats = self.detection_stats
+        scale = stats['scale'] / stats['images'] if stats['images'] else 1.0
+        fallback_rate = stats['fallbacks'] / stats['downscaled'] if stats['downscaled'] else 0.0
+        return 'Detection scale: {:.3f}, fallback rate: {:.2%} ({} of {} faces found at full resolution)'.format(
+            scale, fallback_rate, stats['fallback_faces'], stats['fallbacks'])
+
+    def duplicates_report(self) -> str:
+        return 'Near duplicates skipped: {}'.format(self.near_duplicates)
+
+    def timings_report(self) -> str:
+        return 'Extract time: {:.1f}s, save time: {:.1f}s'.format(self.extract_timings['extract'],
+                                                                  self.extract_timings['save'])
+
+
+def list_images(path: str) -> List[str]:
+    return [path + filename for filename in os.listdir(path) if filename.endswith(IMAGE_EXTENSIONS)]
+
+
+def save_images(images: list, output_path: str, filename: str, encoder=None) -> None:
+    FolderWriter(output_path, Crawler.folders, encoder).write(filename, images)
+
+
+def get_sample_key(path: str) -> str:
+    # writers add extension of the encoder whatever format of downloaded photo is
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def compute_hash(path: str) -> Tuple[str, Optional[int]]:
+    try:
+        return path, dhash(path)
+    except Exception:
+        return path, None
+
+
+def extract(path: str) -> Tuple[str, list, dict]:
+    try:
+        image = LazyImage(path)
+    except Exception:
+        return path, [], {}
     try:
-        images = extractors.extractor(img)
+        images = extractors.extractor(image)
+        detection = extractors.get_models()[0].last_detection
         if images is None:
-            return path, []
+            return path, [], detection
         # number of folders without "full" folder
         if len(images) != len(Crawler.folders) - 1:
-            return path, []
-        return path, images
+            return path, [], detection
+        return path, images, detection
     except Exception:
-        return path, []
+        return path, [], {}
+
+
+def extract_batch(paths: List[str]) -> List[Tuple[str, list, dict]]:
+    imgs = []
+    results = []
+    for path in paths:
+        try:
+            imgs.append((path, LazyImage(path)))
+        except Exception:
+            results.append((path, [], {}))
+
+    batch = extractors.extractor_batch([img for _, img in imgs])
+    detections = extractors.get_models()[0].last_detections
+    if len(detections) != len(imgs):
+        detections = [{}] * len(imgs)
+    for (path, _), images, detection in zip(imgs, batch, detections):
+        # number of folders without "full" folder
+        if images is None or len(images) != len(Crawler.folders) - 1:
+            results.append((path, [], detection))
+        else:
+            results.append((path, images, detection))
+    return results
+
+
+def save_result(path: str, images: list, detection: dict, output_path: Optional[str], extract_time: float,
+                encoder=None) -> dict:
+    # output_path None only encodes images, encoded images are returned to the writer of main process
+    started = time()
+    success = bool(images)
+    encoded = None
+    if success:
+        try:
+            with get_metrics().timer('stage_seconds', stage='encode'):
+                encoded = encode_images(images, encoder)
+            if output_path is not None:
+                with get_metrics().timer('stage_seconds', stage='save'):
+                    save_images(encoded, output_path, get_sample_key(path), encoder)
+                encoded = None
+        except Exception:
+            success = False
+            encoded = None
+    # metrics of this worker since previous result are merged in main process
+    return {'path': path, 'success': success, 'detection': detection, 'encoded': encoded,
+            'timings': {'extract': extract_time, 'save': time() - started}, 'metrics': get_metrics().collect()}
+
+
+def extract_and_save(data: list) -> dict:
+    path, output_path, encoder = data
+    started = time()
+    path, images, detection = extract(path)
+    return save_result(path, images, detection, output_path, time() - started, encoder)
+
+
+def extract_batch_and_save(data: list) -> List[dict]:
+    paths, output_path, encoder = data
+    started = time()
+    results = extract_batch(paths)
+    extract_time = (time() - started) / max(len(results), 1)
+    return [save_result(path, images, detection, output_path, extract_time, encoder)
+            for path, images, detection in results]
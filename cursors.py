@@ -0,0 +1,34 @@
+import json
+import os.path
+from time import time
+from typing import Optional
+
+
+class CursorStore:
+    # pagination checkpoint of one hashtag or user feed, saved after every fully downloaded page
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.checkpoint = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as fp:
+                    self.checkpoint = json.load(fp)
+            except ValueError:
+                self.checkpoint = {}
+
+    @property
+    def next_max_id(self) -> Optional[str]:
+        return self.checkpoint.get('next_max_id')
+
+    @property
+    def exhausted(self) -> bool:
+        return self.checkpoint.get('exhausted', False)
+
+    def save(self, next_max_id: str) -> None:
+        # empty next_max_id means the end of the feed
+        self.checkpoint = {'next_max_id': next_max_id or None, 'exhausted': next_max_id == '',
+                           'pages': self.checkpoint.get('pages', 0) + 1, 'updated': time()}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.checkpoint, fp)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,71 @@
+import os.path
+from io import BytesIO
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import get_metrics
+
+# CDN serves jpeg under any name, format is taken from magic bytes
+SIGNATURES = [(b'\xff\xd8\xff', 'JPEG'), (b'\x89PNG\r\n\x1a\n', 'PNG'), (b'GIF87a', 'GIF'), (b'GIF89a', 'GIF')]
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.webp', '.gif')
+
+
+def sniff_format(header: bytes) -> Optional[str]:
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    for signature, image_format in SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def sniff_file(path: str) -> Optional[str]:
+    with open(path, 'rb') as fp:
+        return sniff_format(fp.read(12))
+
+
+def with_true_extension(path: str, image_format: Optional[str]) -> str:
+    if image_format not in EXTENSIONS:
+        return path
+    return os.path.splitext(path)[0] + EXTENSIONS[image_format]
+
+
+class LazyImage:
+    # file is read once, jpeg is decoded with DCT scaling for detection and at full size only on demand
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.data = fp.read()
+        self.format = sniff_format(self.data[:12])
+        # size is read from header, nothing is decoded yet
+        self.size = Image.open(BytesIO(self.data)).size
+        self.full = None
+        self.full_array = None
+
+    def get_full(self) -> Image.Image:
+        if self.full is None:
+            with get_metrics().timer('stage_seconds', stage='decode'):
+                self.full = Image.open(BytesIO(self.data))
+                self.full.load()
+        return self.full
+
+    def get_array(self) -> np.ndarray:
+        if self.full_array is None:
+            self.full_array = np.array(self.get_full())
+        return self.full_array
+
+    def get_draft(self, max_side: int) -> Tuple[np.ndarray, float]:
+        # returns image with longer side not smaller than max_side and its scale relative to full size,
+        # libjpeg scales by 1/2, 1/4 or 1/8 while decoding, other formats and small images are decoded fully
+        if not max_side or self.format != 'JPEG' or self.full_array is not None or max(self.size) < max_side * 2:
+            return self.get_array(), 1.0
+        with get_metrics().timer('stage_seconds', stage='decode_draft'):
+            img = Image.open(BytesIO(self.data))
+            scale = max_side / max(self.size)
+            img.draft(img.mode, (max(int(self.size[0] * scale), 1), max(int(self.size[1] * scale), 1)))
+            if img.size != self.size:
+                return np.array(img), img.size[0] / self.size[0]
+        return self.get_array(), 1.0
@@ -0,0 +1,47 @@
+from threading import Lock
+from typing import Iterable
+
+
+class DedupIndex:
+    # set of filenames per scope (hashtag or username) plus global set of all scopes
+    # uniq_type 0 is unique inside scope, 1 is unique across all scopes, anything else disables dedup
+    def __init__(self, uniq_type: int = 0) -> None:
+        self.uniq_type = uniq_type
+        self.scopes = {}
+        self.all = set()
+        self.lock = Lock()
+
+    def add(self, scope: str, filenames: Iterable[str]) -> None:
+        filenames = {filename for filename in filenames if filename}
+        with self.lock:
+            self.scopes.setdefault(scope, set()).update(filenames)
+            self.all.update(filenames)
+
+    def claim(self, filename: str, scope: str) -> bool:
+        # atomic check-and-claim, only one thread gets True for the same filename
+        with self.lock:
+            filenames = self.scopes.setdefault(scope, set())
+            if self.uniq_type == 0 and filename in filenames:
+                return False
+            if self.uniq_type == 1 and filename in self.all:
+                return False
+            filenames.add(filename)
+            self.all.add(filename)
+            return True
+
+    def is_claimed(self, filename: str, scope: str) -> bool:
+        with self.lock:
+            return filename in self.scopes.get(scope, ())
+
+    def release(self, filename: str, scope: str) -> None:
+        # gives back a claim of file which was not downloaded
+        with self.lock:
+            self.scopes.get(scope, set()).discard(filename)
+            if not any(filename in filenames for filenames in self.scopes.values()):
+                self.all.discard(filename)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.all
+
+    def __len__(self) -> int:
+        return len(self.all)
@@ -0,0 +1,172 @@
+import os
+import socket
+from time import sleep
+from typing import Callable, List
+
+from crawler import Crawler, list_images
+from workqueue import WorkQueue, WorkItem, Heartbeat
+
+# sources are hashtags and users to crawl, extract items are single downloaded photos leased in batches
+SOURCE = 'source'
+EXTRACT = 'extract'
+
+
+def get_worker_id() -> str:
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_source_items(source_type: str, names: List[str]) -> list:
+    # all sources of the type go with every item, so IMAGES_NUMBER is shared between them like on one node
+    return [('{}:{}:{}'.format(SOURCE, source_type, name), {'type': source_type, 'name': name, 'sources': names})
+            for name in names]
+
+
+def get_extract_items(hashtag: str) -> list:
+    # key is the photo path, so a photo is extracted once whatever node downloaded it
+    full_path = Crawler.base_path + hashtag + Crawler.full_images_path
+    if not os.path.isdir(full_path):
+        return []
+    return [('{}:{}'.format(EXTRACT, path), {'hashtag': hashtag, 'path': path}) for path in list_images(full_path)]
+
+
+def format_counts(queue: WorkQueue) -> str:
+    counts = queue.counts()
+    return '; '.join('{}: {}'.format(kind, ', '.join('{} {}'.format(count, state)
+                                                      for state, count in sorted(states.items())))
+                     for kind, states in sorted(counts.items()))
+
+
+def run_coordinator(queue: WorkQueue, hashtags: List[str], users: List[str], extract: bool = False,
+                    interval: float = 10.0) -> None:
+    # queues sources, or extraction backlog with extract, and reports progress until queue is drained
+    if extract:
+        for hashtag in hashtags:
+            queue.put(EXTRACT, get_extract_items(hashtag))
+    else:
+        # sources are crawled again on every run, already downloaded photos are skipped by download logs
+        queue.put(SOURCE, get_source_items('hashtag', hashtags) + get_source_items('user', users), reopen=True)
+    while True:
+        print('{} | workers: {}'.format(format_counts(queue), len(queue.workers())))
+        if queue.is_drained():
+            return
+        sleep(interval)
+
+
+class Worker:
+    # leases sources first and extraction batches when there are no sources, until queue is drained
+    def __init__(self, queue: WorkQueue, get_crawler: Callable, worker_id: str = None,
+                 extract_batch: int = 16, poll_interval: float = 5.0, extract_only: bool = False) -> None:
+        self.queue = queue
+        self.get_crawler = get_crawler
+        self.worker_id = worker_id if worker_id else get_worker_id()
+        self.extract_batch = extract_batch
+        self.poll_interval = poll_interval
+        # worker started with -e only extracts, its crawlers never download
+        self.extract_only = extract_only
+        self.heartbeat = Heartbeat(queue, self.worker_id, on_lost=self.on_lost)
+        self.crawlers = {}
+        # item id -> (crawler type, hashtag or user) of items being processed
+        self.leased = {}
+
+    def crawler(self, source_type: str):
+        if source_type not in self.crawlers:
+            self.crawlers[source_type] = self.get_crawler(source_type)
+        return self.crawlers[source_type]
+
+    def is_terminated(self) -> bool:
+        return any(crawler.terminate for crawler in self.crawlers.values())
+
+    def on_lost(self, ids: set) -> None:
+        # this worker stalled longer than lease and another one took the items, so the source is stopped here
+        # and never has two writers of its download log and cursor
+        for item_id in ids:
+            source = self.leased.get(item_id)
+            if source and source[0] in self.crawlers:
+                self.crawlers[source[0]].lost_sources.add(source[1])
+
+    def start(self, items: List[WorkItem], source_type: str, name: str) -> list:
+        ids = [item.id for item in items]
+        crawler = self.crawler(source_type)
+        crawler.lost_sources.discard(name)
+        for item_id in ids:
+            self.leased[item_id] = (source_type, name)
+        return ids
+
+    def finish(self, ids: list, source_type: str, name: str) -> None:
+        # lost items are released, not completed, release of an item owned by another worker does nothing
+        crawler = self.crawlers[source_type]
+        if crawler.terminate or name in crawler.lost_sources:
+            self.queue.release(self.worker_id, ids)
+        else:
+            self.queue.complete(self.worker_id, ids)
+
+    def process_source(self, item: WorkItem) -> None:
+        source_type, name = item.payload['type'], item.payload['name']
+        ids = self.start([item], source_type, name)
+        crawler = self.crawlers[source_type]
+        # stage switched to extraction by the previous source does not skip downloading of this one
+        crawler.stage = 0
+        crawler.set_sources(item.payload.get('sources', [name]))
+        crawler.process(name)
+        if crawler.stage != 0 and not crawler.terminate and name not in crawler.lost_sources:
+            # download was cut by e or IMAGES_NUMBER of this node, the source is retried on other nodes
+            # up to max_attempts and is never marked done half crawled
+            self.queue.fail(self.worker_id, ids)
+            return
+        # photos downloaded without extraction are shared between all nodes
+        if source_type == 'hashtag' and not crawler.pipeline and \
+                not crawler.terminate and name not in crawler.lost_sources:
+            self.queue.put(EXTRACT, get_extract_items(name))
+        self.finish(ids, source_type, name)
+
+    def process_extraction(self, items: List[WorkItem]) -> None:
+        by_hashtag = {}
+        for item in items:
+            by_hashtag.setdefault(item.payload['hashtag'], []).append(item)
+        for hashtag, hashtag_items in by_hashtag.items():
+            ids = self.start(hashtag_items, 'hashtag', hashtag)
+            crawler = self.crawlers['hashtag']
+            if crawler.terminate:
+                self.queue.release(self.worker_id, ids)
+                continue
+            for folder in crawler.folders:
+                os.makedirs(crawler.base_path + hashtag + folder, exist_ok=True)
+            paths = [item.payload['path'] for item in hashtag_items if os.path.isfile(item.payload['path'])]
+            crawler.extract_paths(hashtag, paths)
+            self.finish(ids, 'hashtag', hashtag)
+
+    def run(self) -> None:
+        self.heartbeat.start()
+        try:
+            while not self.is_terminated():
+                items = [] if self.extract_only else self.queue.lease(self.worker_id, SOURCE)
+                kind = SOURCE
+                if not items:
+                    items = self.queue.lease(self.worker_id, EXTRACT, self.extract_batch)
+                    kind = EXTRACT
+                if not items:
+                    if self.queue.is_drained(EXTRACT if self.extract_only else None):
+                        return
+                    # other workers hold the rest, their items come back if they die
+                    sleep(self.poll_interval)
+                    continue
+                ids = [item.id for item in items]
+                self.heartbeat.add(ids)
+                try:
+                    if kind == SOURCE:
+                        self.process_source(items[0])
+                    else:
+                        self.process_extraction(items)
+                except Exception as e:
+                    # item is leased again until it fails max_attempts times, the worker takes next items
+                    print('Failed {} items {}: {!r}'.format(kind, ids, e))
+                    self.queue.fail(self.worker_id, ids)
+                finally:
+                    self.heartbeat.remove(ids)
+                    for item_id in ids:
+                        self.leased.pop(item_id, None)
+        finally:
+            self.heartbeat.stop()
+            for crawler in self.crawlers.values():
+                if hasattr(crawler, 'close_writers'):
+                    crawler.close_writers()
@@ -0,0 +1,130 @@
+import os.path
+import sqlite3
+from threading import Lock
+from typing import List
+
+from decoding import IMAGE_EXTENSIONS
+
+
+class DownloadLog:
+    # append-only log of downloaded filenames, one per line, history is never rewritten on start
+    def __init__(self, path: str, fsync_every: int = 0) -> None:
+        self.path = path
+        self.fsync_every = fsync_every
+        self.lock = Lock()
+        self.fp = None
+        self.unsynced = 0
+
+    def load(self) -> List[str]:
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as fp:
+            return [line.strip() for line in fp if line.strip()]
+
+    def open(self) -> None:
+        # older versions could leave last line without line break
+        needs_newline = False
+        if os.path.isfile(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                needs_newline = fp.read(1) != b'\n'
+        self.fp = open(self.path, 'a', buffering=1)
+        if needs_newline:
+            self.fp.write('\n')
+
+    def append(self, filename: str) -> None:
+        with self.lock:
+            if self.fp is None:
+                self.open()
+            self.fp.write(filename + '\n')
+            self.unsynced += 1
+            if self.fsync_every and self.unsynced >= self.fsync_every:
+                self.sync()
+
+    def sync(self) -> None:
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.unsynced = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.fp is None:
+                return
+            self.sync()
+            self.fp.close()
+            self.fp = None
+
+    def compact(self, images_path: str) -> int:
+        # drops duplicates and orphan entries without downloaded file, returns number of dropped entries
+        with self.lock:
+            entries = self.load()
+            kept = list(dict.fromkeys(entry for entry in entries if is_downloaded(images_path, entry)))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                fp.write(''.join(entry + '\n' for entry in kept))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+            return len(entries) - len(kept)
+
+
+class SqliteDownloadLog:
+    # the same log in sqlite for fast start on large histories, text log is imported on first open
+    def __init__(self, path: str, text_log_path: str = None, fsync_every: int = 0) -> None:
+        self.path = path
+        self.text_log_path = text_log_path
+        self.fsync_every = fsync_every
+        self.lock = Lock()
+        self.unsynced = 0
+        is_new = not os.path.isfile(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS downloaded (filename TEXT PRIMARY KEY)')
+        if is_new and text_log_path:
+            self.insert(DownloadLog(text_log_path).load())
+        self.connection.commit()
+
+    def insert(self, filenames: List[str]) -> None:
+        self.connection.executemany('INSERT OR IGNORE INTO downloaded (filename) VALUES (?)',
+                                    ((filename,) for filename in filenames))
+
+    def load(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT filename FROM downloaded')]
+
+    def append(self, filename: str) -> None:
+        with self.lock:
+            self.insert([filename])
+            self.unsynced += 1
+            if self.unsynced >= max(self.fsync_every, 1):
+                self.connection.commit()
+                self.unsynced = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def compact(self, images_path: str) -> int:
+        with self.lock:
+            orphans = [row[0] for row in self.connection.execute('SELECT filename FROM downloaded')
+                       if not is_downloaded(images_path, row[0])]
+            self.connection.executemany('DELETE FROM downloaded WHERE filename = ?', ((name,) for name in orphans))
+            self.connection.commit()
+            return len(orphans)
+
+
+def is_downloaded(images_path: str, filename: str) -> bool:
+    # file may be saved with its true extension instead of logged .png
+    stem = os.path.splitext(os.path.join(images_path, filename))[0]
+    for path in [os.path.join(images_path, filename)] + [stem + extension for extension in IMAGE_EXTENSIONS]:
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            return True
+    return False
+
+
+def open_download_log(path: str, backend: str = 'text', fsync_every: int = 0):
+    # path is a folder of hashtag or user
+    text_log_path = os.path.join(path, 'downloaded_images.txt')
+    if backend == 'sqlite':
+        return SqliteDownloadLog(os.path.join(path, 'downloaded_images.sqlite'), text_log_path, fsync_every)
+    return DownloadLog(text_log_path, fsync_every)
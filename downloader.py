@@ -0,0 +1,23 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Downloader:
+    # shared keep-alive session, connections to every host are limited by connections_per_host
+    def __init__(self, connections_per_host: int = 32, hosts: int = 16,
+                 chunk_size: int = 64 * 1024, timeout: tuple = (10, 60)) -> None:
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=connections_per_host, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url: str) -> requests.Response:
+        return self.session.get(url, stream=True, timeout=self.timeout)
+
+    def iter_content(self, response: requests.Response):
+        return response.iter_content(self.chunk_size)
+
+    def close(self) -> None:
+        self.session.close()
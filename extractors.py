@@ -1,4 +1,4 @@
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Callable
 from PIL.JpegImagePlugin import JpegImageFile
 import numpy as np
 from PIL import Image
@@ -6,8 +6,19 @@ import extcolors
 import cv2
 import dlib
 
+from decoding import LazyImage
+from metrics import get_metrics
+
 
 class PaletteExtractor:
+    def __init__(self, backend: str = 'extcolors', tolerance: int = 32,
+                 max_pixels: int = 100000, bits: int = 5) -> None:
+        # backend is "extcolors" or "numpy", tolerance is CIE76 delta E used by both backends to merge colors
+        self.backend = backend
+        self.tolerance = tolerance
+        self.max_pixels = max_pixels
+        self.bits = bits
+
     def get_palette(self, img: JpegImageFile, proportionately: bool = False,
                     height: int = 300, width: int = 50) -> JpegImageFile:
         colors = self.get_colors(img)
@@ -15,7 +26,42 @@ class PaletteExtractor:
         return Image.fromarray(palette)
 
     def get_colors(self, img: JpegImageFile) -> list:
-        colors, _ = extcolors.extract_from_image(img)
+        if self.backend == 'numpy':
+            return self.get_colors_numpy(img)
+        colors, _ = extcolors.extract_from_image(img, tolerance=self.tolerance)
+        return colors
+
+    def get_colors_numpy(self, img: JpegImageFile) -> list:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        pixels = np.asarray(img).reshape(-1, 3)
+        step = max(int(np.ceil(len(pixels) / self.max_pixels)), 1)
+        pixels = pixels[::step]
+
+        # quantize to packed integer, keep mean color of every bin
+        shift = 8 - self.bits
+        quantized = pixels >> shift
+        packed = ((quantized[:, 0].astype(np.int32) << (2 * self.bits)) |
+                  (quantized[:, 1].astype(np.int32) << self.bits) | quantized[:, 2])
+        bins, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+        means = np.stack([np.bincount(inverse, weights=pixels[:, channel]) for channel in range(3)], axis=1)
+        means = np.round(means / counts[:, None]).astype(np.uint8)
+
+        order = np.argsort(-counts, kind='stable')
+        counts, means = counts[order] * step, means[order]
+
+        # the same greedy merging as extcolors: the most frequent color absorbs all close colors
+        lab = cv2.cvtColor(means.reshape(-1, 1, 3).astype(np.float32) / 255, cv2.COLOR_RGB2LAB).reshape(-1, 3)
+        merged = np.zeros(len(counts), dtype=bool)
+        colors = []
+        for i in range(len(counts)):
+            if merged[i]:
+                continue
+            close = ~merged[i:] & (np.linalg.norm(lab[i:] - lab[i], axis=1) < self.tolerance)
+            close[0] = True
+            merged[i:] |= close
+            colors.append((tuple(int(c) for c in means[i]), int(counts[i:][close].sum())))
+        colors.sort(key=lambda color: color[1], reverse=True)
         return colors
 
     def create_color_palette(self, colors: list, proportionately: bool = False,
@@ -30,15 +76,27 @@ class PaletteExtractor:
             if proportionately:
                 percent = pixels_count / total_pixels
             end_y = start_y + (percent * height)
-            top_left_corner = (0, int(start_y))
-            bottom_right_corner = (width, int(end_y))
-            cv2.rectangle(bar, top_left_corner, bottom_right_corner, np.array(color).astype("uint8").tolist(), -1)
+            # the same rows as filled cv2.rectangle, bottom row is inclusive
+            bar[int(start_y):int(end_y) + 1] = color
             start_y = end_y
         return bar
 
 
+# bump when extraction output changes, incremental mode re-extracts images of older versions
+EXTRACTOR_VERSION = '1'
+
+# bit flags of base regions in the label map
+LEFT_EYE = 1
+RIGHT_EYE = 2
+LEFT_EYELID = 4
+RIGHT_EYELID = 8
+MOUTH = 16
+TEETH = 32
+
+
 class MakeupExtractor:
-    def __init__(self, use_cnn=False) -> None:
+    def __init__(self, use_cnn=False, detection_size: int = 0, detection_fallback: bool = False,
+                 cnn_upsample: int = 0) -> None:
         # define landmarks numbers for different regions
         self.left_eyelid = [0] + list(range(17, 22)) + [27, 28]
         self.right_eyelid = [28, 27] + list(range(22, 27)) + [16]
@@ -50,7 +108,33 @@ class MakeupExtractor:
         self.mouth = list(range(48, 60))
         self.teeth = list(range(60, 68))
 
+        self.base_regions = [(LEFT_EYE, self.left_eye), (RIGHT_EYE, self.right_eye),
+                             (LEFT_EYELID, self.left_eyelid), (RIGHT_EYELID, self.right_eyelid),
+                             (MOUTH, self.mouth), (TEETH, self.teeth)]
+
+        # output crops in Crawler.folders order:
+        # mask is a union of (include, exclude) label terms, crop box is taken from regions landmarks
+        self.outputs = [
+            ([(LEFT_EYE, 0)], [self.left_eye]),
+            ([(RIGHT_EYE, 0)], [self.right_eye]),
+            ([(LEFT_EYE | RIGHT_EYE, 0)], [self.left_eye, self.right_eye]),
+            ([(LEFT_EYELID, LEFT_EYE)], [self.left_eyelid]),
+            ([(RIGHT_EYELID, RIGHT_EYE)], [self.right_eyelid]),
+            ([(LEFT_EYELID | RIGHT_EYELID, LEFT_EYE | RIGHT_EYE)], self.eyelids),
+            ([(TEETH, 0)], [self.teeth]),
+            ([(MOUTH, 0)], [self.mouth]),
+            ([(MOUTH, TEETH)], [self.mouth]),
+            ([(LEFT_EYELID | RIGHT_EYELID, LEFT_EYE | RIGHT_EYE), (MOUTH, TEETH)], self.eyelids + [self.mouth]),
+        ]
+
+        # detection runs on a copy with longer side not bigger than detection_size, 0 is full resolution
+        self.detection_size = detection_size
+        self.detection_fallback = detection_fallback
+        self.last_detection = {}
+        self.last_detections = []
+
         self.use_cnn = use_cnn
+        self.cnn_upsample = cnn_upsample
         if self.use_cnn:
             detector_weights_path = 'mmod_human_face_detector.dat'
             self.face_detector = dlib.cnn_face_detection_model_v1(detector_weights_path)
@@ -59,84 +143,72 @@ class MakeupExtractor:
         predictor_weights_path = 'shape_predictor_68_face_landmarks.dat'
         self.landmarks_predictor = dlib.shape_predictor(predictor_weights_path)
 
-    def get_landmarks(self, img: np.ndarray, face: dlib.rectangle, regions: list) -> list:
-        points = []
-        for region in regions:
-            landmarks = self.landmarks_predictor(image=img, box=face)
-            cur_points = []
-            for n in region:
-                x = landmarks.part(n).x
-                y = landmarks.part(n).y
-                cur_points.append(np.array([x, y]))
-            points.append(np.array(cur_points))
-        return points
-
-    def get_mask(self, img: np.ndarray, points: list) -> np.ndarray:
-        mask = np.zeros(img.shape[:2], dtype=np.uint8)
-        mask = cv2.fillPoly(mask, points, 255)
+    def get_landmarks(self, img: np.ndarray, face: dlib.rectangle) -> np.ndarray:
+        with get_metrics().timer('stage_seconds', stage='landmarks'):
+            return self.predict_landmarks(img, face)
+
+    def predict_landmarks(self, img: np.ndarray, face: dlib.rectangle) -> np.ndarray:
+        # all 68 points as (68, 2) array, predictor runs once per face
+        landmarks = self.landmarks_predictor(image=img, box=face)
+        return np.array([[point.x, point.y] for point in landmarks.parts()], dtype=np.int32)
+
+    def get_regions(self, landmarks: np.ndarray, regions: list) -> list:
+        return [landmarks[region] for region in regions]
+
+    def get_label_map(self, img_shape: tuple, landmarks: np.ndarray) -> Tuple[np.ndarray, int, int]:
+        # label map covers only bounding box of all regions, (left, top) is its offset in the image
+        height, width = img_shape[:2]
+        points = np.concatenate(self.get_regions(landmarks, [region for _, region in self.base_regions]))
+        left, top = np.maximum(points.min(axis=0), 0)
+        right, bottom = np.minimum(points.max(axis=0) + 1, [width, height])
+        label_map = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=np.uint8)
+
+        for label, region in self.base_regions:
+            polygon = landmarks[region]
+            x0, y0 = np.maximum(polygon.min(axis=0), [left, top])
+            x1, y1 = np.minimum(polygon.max(axis=0) + 1, [right, bottom])
+            if x1 <= x0 or y1 <= y0:
+                continue
+            region_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.fillPoly(region_mask, [polygon], label, offset=(-int(x0), -int(y0)))
+            label_map[y0 - top:y1 - top, x0 - left:x1 - left] |= region_mask
+        return label_map, int(left), int(top)
+
+    def get_region_mask(self, labels: np.ndarray, terms: list) -> np.ndarray:
+        mask = np.zeros(labels.shape, dtype=bool)
+        for include, exclude in terms:
+            mask |= ((labels & include) != 0) & ((labels & exclude) == 0)
         return mask
 
-    def add_transparent_background(self, img: np.ndarray, mask: np.ndarray) -> np.ndarray:
-        res = img.copy()
-        res = cv2.cvtColor(res, cv2.COLOR_BGR2BGRA)
-        res[:, :, 3] = mask[:, :, 0]
-        return res
-
-    def get_eye(self, img: np.ndarray,
-                face: dlib.rectangle, part: int = 2) -> Tuple[np.ndarray, list]:
-        # 0 is left eye, 1 is right, 2 is both
-        if part == 0:
-            regions = [self.left_eye]
-        elif part == 1:
-            regions = [self.right_eye]
-        else:
-            regions = [self.left_eye, self.right_eye]
-        eyes_landmarks = self.get_landmarks(img, face, regions)
-        eyes_mask = self.get_mask(img, eyes_landmarks)
-        return eyes_mask, eyes_landmarks
-
-    def get_eyelid(self, img: np.ndarray,
-                   face: dlib.rectangle, part: int = 2) -> Tuple[np.ndarray, list]:
-        # 0 is left eyelid, 1 is right, 2 is both
-        if part == 0:
-            regions = [self.left_eyelid]
-        elif part == 1:
-            regions = [self.right_eyelid]
-        else:
-            regions = [self.left_eyelid, self.right_eyelid]
-        eyelids_landmarks = self.get_landmarks(img, face, regions)
-        eyelids_mask = self.get_mask(img, eyelids_landmarks)
-        return eyelids_mask, eyelids_landmarks
-
-    def get_teeth(self, img: np.ndarray, face: dlib.rectangle) -> Tuple[np.ndarray, list]:
-        teeth_landmarks = self.get_landmarks(img, face, [self.teeth])
-        teeth_mask = self.get_mask(img, teeth_landmarks)
-        return teeth_mask, teeth_landmarks
-
-    def get_mouth(self, img: np.ndarray, face: dlib.rectangle) -> Tuple[np.ndarray, list]:
-        mouth_landmarks = self.get_landmarks(img, face, [self.mouth])
-        mouth_mask = self.get_mask(img, mouth_landmarks)
-        return mouth_mask, mouth_landmarks
-
     def get_crop_coordinates(self, landmarks: list) -> Tuple[int, int, int, int]:
-        top = np.min([y for coordinate in landmarks for x, y in coordinate])
-        bottom = np.max([y for coordinate in landmarks for x, y in coordinate])
-        left = np.min([x for coordinate in landmarks for x, y in coordinate])
-        right = np.max([x for coordinate in landmarks for x, y in coordinate])
+        points = np.concatenate(landmarks)
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
         return top, right, bottom, left
 
-    def get_image_from_mask(self, img: np.ndarray, mask: np.ndarray, landmarks: list) -> JpegImageFile:
-        mask = np.array([mask] * 3)
-        mask = np.transpose(mask, [1, 2, 0])
-        img_mask = cv2.bitwise_and(img, mask)
+    def get_crop(self, img: np.ndarray, label_map: np.ndarray, offset: Tuple[int, int],
+                 terms: list, landmarks: list) -> JpegImageFile:
         top, right, bottom, left = self.get_crop_coordinates(landmarks)
-        img_crop = img_mask[top:bottom, left:right]
-        mask_crop = mask[top:bottom, left:right]
-        transparent_img = Image.fromarray(self.add_transparent_background(img_crop, mask_crop))
-        return transparent_img
-
-    def get_face(self, img: np.ndarray) -> Optional[dlib.rectangle]:
-        faces = self.face_detector(img)
+        top, left = max(top, 0), max(left, 0)
+        bottom, right = min(bottom, img.shape[0]), min(right, img.shape[1])
+        offset_left, offset_top = offset
+
+        labels = label_map[top - offset_top:bottom - offset_top, left - offset_left:right - offset_left]
+        mask = self.get_region_mask(labels, terms)
+        img_crop = img[top:bottom, left:right]
+
+        # BGRA crop with transparent background outside of the mask
+        transparent_img = np.zeros(mask.shape + (4,), dtype=np.uint8)
+        transparent_img[mask, :3] = img_crop[mask]
+        transparent_img[mask, 3] = 255
+        return Image.fromarray(transparent_img)
+
+    def detect_face(self, img: np.ndarray) -> Optional[dlib.rectangle]:
+        with get_metrics().timer('stage_seconds', stage='detect'):
+            if self.use_cnn:
+                faces = self.face_detector(img, self.cnn_upsample)
+            else:
+                faces = self.face_detector(img)
         if not faces:
             return None
         if self.use_cnn:
@@ -145,68 +217,193 @@ class MakeupExtractor:
             face = faces[0]
         return face
 
+    def get_detection_scale(self, img: np.ndarray) -> float:
+        longer_side = max(img.shape[:2])
+        if not self.detection_size or longer_side <= self.detection_size:
+            return 1.0
+        return self.detection_size / longer_side
+
+    def resize_for_detection(self, img: np.ndarray, scale: float) -> np.ndarray:
+        if scale == 1:
+            return img
+        height, width = img.shape[:2]
+        size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def rescale_face(self, face: dlib.rectangle, scale: float) -> dlib.rectangle:
+        return dlib.rectangle(int(round(face.left() / scale)), int(round(face.top() / scale)),
+                              int(round(face.right() / scale)), int(round(face.bottom() / scale)))
+
+    def get_face(self, img: np.ndarray, base_scale: float = 1.0,
+                 get_full: Callable[[], np.ndarray] = None) -> Optional[dlib.rectangle]:
+        # img may be already reduced by base_scale while decoding, get_full decodes full resolution for fallback
+        scale = self.get_detection_scale(img) * base_scale
+        self.last_detection = {'scale': scale, 'fallback': False, 'found': False}
+        face = None
+        if scale < 1:
+            face = self.detect_face(self.resize_for_detection(img, scale / base_scale))
+            if face:
+                face = self.rescale_face(face, scale)
+        if not face and (scale == 1 or self.detection_fallback):
+            self.last_detection['fallback'] = scale < 1
+            face = self.detect_face(img if base_scale == 1 else get_full())
+        self.last_detection['found'] = bool(face)
+        return face
+
+    def get_faces(self, imgs: List[np.ndarray], base_scales: List[float] = None,
+                  get_fulls: List[Callable[[], np.ndarray]] = None) -> List[Optional[dlib.rectangle]]:
+        # CNN detector gets one batched call per bucket of equally sized detection images
+        base_scales = base_scales or [1.0] * len(imgs)
+        get_fulls = get_fulls or [None] * len(imgs)
+        if not self.use_cnn:
+            faces = []
+            self.last_detections = []
+            for img, base_scale, get_full in zip(imgs, base_scales, get_fulls):
+                faces.append(self.get_face(img, base_scale, get_full))
+                self.last_detections.append(self.last_detection)
+            return faces
+
+        img_scales = [self.get_detection_scale(img) for img in imgs]
+        scales = [scale * base_scale for scale, base_scale in zip(img_scales, base_scales)]
+        detection_imgs = [self.resize_for_detection(img, scale) for img, scale in zip(imgs, img_scales)]
+        buckets = {}
+        for i, detection_img in enumerate(detection_imgs):
+            buckets.setdefault(detection_img.shape, []).append(i)
+
+        faces = [None] * len(imgs)
+        for indices in buckets.values():
+            batch = [detection_imgs[i] for i in indices]
+            with get_metrics().timer('stage_seconds', stage='detect'):
+                found_faces = self.face_detector(batch, self.cnn_upsample, batch_size=len(batch))
+            for i, found in zip(indices, found_faces):
+                if found:
+                    faces[i] = self.rescale_face(found[0].rect, scales[i])
+
+        self.last_detections = []
+        for i, img in enumerate(imgs):
+            detection = {'scale': scales[i], 'fallback': False, 'found': False}
+            if not faces[i] and scales[i] < 1 and self.detection_fallback:
+                detection['fallback'] = True
+                faces[i] = self.detect_face(img if base_scales[i] == 1 else get_fulls[i]())
+            detection['found'] = bool(faces[i])
+            self.last_detections.append(detection)
+        return faces
+
+    def extract_face(self, img: np.ndarray, face: dlib.rectangle) -> List[JpegImageFile]:
+        landmarks = self.get_landmarks(img, face)
+        with get_metrics().timer('stage_seconds', stage='crop'):
+            label_map, left, top = self.get_label_map(img.shape, landmarks)
+            return [self.get_crop(img, label_map, (left, top), terms, self.get_regions(landmarks, regions))
+                    for terms, regions in self.outputs]
+
     def extract(self, img: JpegImageFile) -> Optional[List[JpegImageFile]]:
+        self.last_detection = {}
         img = np.array(img)
 
         # face boundary box
         face = self.get_face(img)
         if not face:
             return None
+        return self.extract_face(img, face)
 
-        # left eye
-        left_eye_mask, left_eye_landmarks = self.get_eye(img, face, 0)
-        left_eye = self.get_image_from_mask(img, left_eye_mask, left_eye_landmarks)
-
-        # right eye
-        right_eye_mask, right_eye_landmarks = self.get_eye(img, face, 1)
-        right_eye = self.get_image_from_mask(img, right_eye_mask, right_eye_landmarks)
-
-        # left and right eyes
-        left_right_eyes_mask, left_right_eyes_landmarks = self.get_eye(img, face, 2)
-        left_right_eyes = self.get_image_from_mask(img, left_right_eyes_mask, left_right_eyes_landmarks)
+    def extract_image(self, image: LazyImage) -> Optional[List[JpegImageFile]]:
+        # detection runs on reduced jpeg decode, full image is decoded only when a face is found
+        self.last_detection = {}
+        img, base_scale = image.get_draft(self.detection_size)
+        face = self.get_face(img, base_scale, image.get_array)
+        if not face:
+            return None
+        return self.extract_face(image.get_array(), face)
 
-        # left eyelid
-        left_eyelid_mask, left_eyelid_landmarks = self.get_eyelid(img, face, 0)
-        left_eyelid_mask = cv2.bitwise_and(left_eyelid_mask, (255 - left_eye_mask))
-        left_eyelid = self.get_image_from_mask(img, left_eyelid_mask, left_eyelid_landmarks)
 
-        # right eyelid
-        right_eyelid_mask, right_eyelid_landmarks = self.get_eyelid(img, face, 1)
-        right_eyelid_mask = cv2.bitwise_and(right_eyelid_mask, (255 - right_eye_mask))
-        right_eyelid = self.get_image_from_mask(img, right_eyelid_mask, right_eyelid_landmarks)
+_makeup_extractor = None
+_palette_extractor = None
 
-        # left and right eyelids
-        left_right_eyelids_mask, left_right_eyelids_landmarks = self.get_eyelid(img, face, 2)
-        left_right_eyelids_mask = cv2.bitwise_and(left_right_eyelids_mask, (255 - left_right_eyes_mask))
-        left_right_eyelids = self.get_image_from_mask(img, left_right_eyelids_mask, left_right_eyelids_landmarks)
 
-        # teeth
-        teeth_mask, teeth_landmarks = self.get_teeth(img, face)
-        teeth = self.get_image_from_mask(img, teeth_mask, teeth_landmarks)
+def load_models(use_cnn: bool = False, detection_size: int = 0, detection_fallback: bool = False,
+                palette_backend: str = 'extcolors', palette_tolerance: int = 32, cnn_upsample: int = 0) -> None:
+    # loads models once per process, used by pool initializer and for preloading in parent
+    global _makeup_extractor, _palette_extractor
+    if _makeup_extractor is None or _makeup_extractor.use_cnn != use_cnn:
+        _makeup_extractor = MakeupExtractor(use_cnn, detection_size, detection_fallback, cnn_upsample)
+    _makeup_extractor.detection_size = detection_size
+    _makeup_extractor.detection_fallback = detection_fallback
+    _makeup_extractor.cnn_upsample = cnn_upsample
+    if _palette_extractor is None:
+        _palette_extractor = PaletteExtractor(palette_backend, palette_tolerance)
+    _palette_extractor.backend = palette_backend
+    _palette_extractor.tolerance = palette_tolerance
 
-        # mouth
-        mouth_mask, mouth_landmarks = self.get_mouth(img, face)
-        mouth = self.get_image_from_mask(img, mouth_mask, mouth_landmarks)
 
-        # lips
-        lips_mask = cv2.bitwise_and(mouth_mask, (255 - teeth_mask))
-        lips = self.get_image_from_mask(img, lips_mask, mouth_landmarks)
+def init_worker(*args) -> None:
+    # pool initializer, forked workers start with empty metrics, so parent values are not sent back,
+    # metrics of the parent itself are kept when models are preloaded there
+    get_metrics().reset()
+    load_models(*args)
 
-        # eyelids and lips
-        eyelids_lips_mask = cv2.bitwise_or(left_right_eyelids_mask, lips_mask)
-        eyelids_lips = self.get_image_from_mask(img, eyelids_lips_mask, left_right_eyelids_landmarks + mouth_landmarks)
 
-        return [left_eye, right_eye, left_right_eyes, left_eyelid, right_eyelid, left_right_eyelids,
-                teeth, mouth, lips, eyelids_lips]
+def get_models() -> Tuple[MakeupExtractor, PaletteExtractor]:
+    if _makeup_extractor is None or _palette_extractor is None:
+        load_models()
+    return _makeup_extractor, _palette_extractor
 
 
-def extractor(img: JpegImageFile) -> Optional[list]:
-    makeup_extractor = MakeupExtractor()
+def extractor(image: LazyImage) -> Optional[list]:
+    makeup_extractor, palette_extractor = get_models()
     try:
-        images = makeup_extractor.extract(img)
+        images = makeup_extractor.extract_image(image)
         if images is not None:
-            palette_extractor = PaletteExtractor()
-            palette_img = palette_extractor.get_palette(img)
+            full = image.get_full()
+            with get_metrics().timer('stage_seconds', stage='palette'):
+                palette_img = palette_extractor.get_palette(full)
             return images + [palette_img]
     except Exception:
         return None
+
+
+def extractor_batch(images: List[LazyImage]) -> List[Optional[list]]:
+    makeup_extractor, palette_extractor = get_models()
+    # detections of previous batch are never left for this one, there is one entry per image
+    makeup_extractor.last_detections = []
+    # a file which fails to decode drops only itself from the batch
+    drafts = {}
+    for i, image in enumerate(images):
+        try:
+            drafts[i] = image.get_draft(makeup_extractor.detection_size)
+        except Exception:
+            continue
+    indices = list(drafts)
+    try:
+        found_faces = makeup_extractor.get_faces([drafts[i][0] for i in indices], [drafts[i][1] for i in indices],
+                                                 [images[i].get_array for i in indices])
+        found_detections = makeup_extractor.last_detections
+    except Exception:
+        # full decode for fallback may fail on one file, the batch is detected again image by image
+        found_faces, found_detections = [], []
+        for i in indices:
+            try:
+                found_faces.append(makeup_extractor.get_face(drafts[i][0], drafts[i][1], images[i].get_array))
+                found_detections.append(makeup_extractor.last_detection)
+            except Exception:
+                found_faces.append(None)
+                found_detections.append({})
+    faces = [None] * len(images)
+    detections = [{}] * len(images)
+    for i, face, detection in zip(indices, found_faces, found_detections):
+        faces[i] = face
+        detections[i] = detection
+    makeup_extractor.last_detections = detections
+
+    results = []
+    for image, face in zip(images, faces):
+        try:
+            if face is None:
+                results.append(None)
+                continue
+            crops = makeup_extractor.extract_face(image.get_array(), face)
+            full = image.get_full()
+            with get_metrics().timer('stage_seconds', stage='palette'):
+                results.append(crops + [palette_extractor.get_palette(full)])
+        except Exception:
+            results.append(None)
+    return results
@@ -0,0 +1,58 @@
+import os.path
+from io import BytesIO
+from typing import List
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def synthetic_face(width: int = 1080, height: int = 1350, seed: int = 0, quality: int = 90) -> bytes:
+    # frontal face drawing on a noisy background, close enough to a photo for decode and encode timings,
+    # detectors are not guaranteed to find it, real photos from a fixtures folder give detection numbers
+    random = np.random.RandomState(seed)
+    background = random.randint(40, 220, size=3)
+    noise = random.normal(0, 12, (height, width, 3))
+    pixels = np.clip(background + noise, 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(img)
+
+    face_width = int(width * random.uniform(0.35, 0.55))
+    face_height = int(face_width * 1.3)
+    cx = width // 2 + random.randint(-width // 10, width // 10)
+    cy = height // 2 + random.randint(-height // 10, height // 10)
+    skin = tuple(int(c) for c in random.randint([150, 100, 80], [255, 210, 180]))
+    draw.ellipse([cx - face_width // 2, cy - face_height // 2, cx + face_width // 2, cy + face_height // 2], skin)
+
+    eye_y = cy - face_height // 8
+    eye_dx = face_width // 5
+    eye_w, eye_h = face_width // 8, face_height // 24
+    brow = tuple(int(c * 0.3) for c in skin)
+    for ex in (cx - eye_dx, cx + eye_dx):
+        draw.rectangle([ex - eye_w, eye_y - eye_h * 4, ex + eye_w, eye_y - eye_h * 3], brow)
+        draw.ellipse([ex - eye_w, eye_y - eye_h, ex + eye_w, eye_y + eye_h], (245, 245, 245))
+        draw.ellipse([ex - eye_h, eye_y - eye_h, ex + eye_h, eye_y + eye_h], (60, 40, 30))
+    nose = tuple(int(c * 0.8) for c in skin)
+    nose_y = cy + face_height // 8
+    draw.polygon([(cx, eye_y + eye_h), (cx - eye_w // 2, nose_y), (cx + eye_w // 2, nose_y)], nose)
+    mouth_y = cy + face_height // 4
+    lips = tuple(int(c) for c in random.randint([150, 20, 40], [230, 90, 110]))
+    draw.ellipse([cx - face_width // 5, mouth_y - eye_h * 2, cx + face_width // 5, mouth_y + eye_h * 2], lips)
+
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def synthetic_faces(count: int = 16, width: int = 1080, height: int = 1350) -> List[bytes]:
+    return [synthetic_face(width, height, seed) for seed in range(count)]
+
+
+def load_fixtures(folder: str) -> List[bytes]:
+    # real photos for repeatable extraction numbers, every jpeg in the folder is served by mock CDN
+    images = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.lower().endswith(('.jpg', '.jpeg')):
+            with open(os.path.join(folder, filename), 'rb') as fp:
+                images.append(fp.read())
+    return images
@@ -1,21 +1,29 @@
 import argparse
 import os.path
+from functools import partial
 from multiprocessing import Pool
 from threading import Thread
 
 from dotenv import load_dotenv
 from progress.bar import Bar
 
+import extractors
+from clients import create_client_pool
 from crawler import Crawler
+from distributed import Worker, get_worker_id, run_coordinator
+from downloader import Downloader
+from metrics import MetricsExporter, get_metrics
+from ratelimit import AdaptiveRateLimiter
+from scheduler import DownloadScheduler
 from users import UsersCrawler
+from workqueue import WorkQueue
 
 
 def run_hashtags_search(hashtags, crawler):
+    hashtags = [hashtag[1:] if hashtag.startswith('#') else hashtag for hashtag in hashtags]
+    crawler.set_sources(hashtags)
     threads = []
     for hashtag in hashtags:
-        if hashtag.startswith('#'):
-            hashtag = hashtag[1:]
-
         thread = Thread(target=crawler.process,
                         args=(hashtag,))
         thread.start()
@@ -26,6 +34,7 @@ def run_hashtags_search(hashtags, crawler):
 
 
 def run_users_search(users, crawler):
+    crawler.set_sources(users)
     threads = []
     for user in users:
         thread = Thread(target=crawler.process,
@@ -46,6 +55,14 @@ if __name__ == '__main__':
                         help='skip image downloading and run extractor for hashtags')
     parser.add_argument('--users', type=str, required=False,
                         help="download all user photos, e.g. \"tomholland2013 zendaya\"")
+    parser.add_argument('--coordinator', action='store_true',
+                        help='put hashtags and users (or extraction with -e) to shared queue and wait for workers')
+    parser.add_argument('--worker', action='store_true',
+                        help='take hashtags, users and extraction from shared queue until it is drained')
+    parser.add_argument('--queue', type=str, default='data/queue.sqlite',
+                        help='path to shared queue, it has to be on storage mounted by all nodes')
+    parser.add_argument('--worker-id', type=str, required=False,
+                        help='unique worker name, hostname-pid by default')
     args = parser.parse_args()
 
     INSTAGRAM_LOGIN = os.getenv('INSTAGRAM_LOGIN')
@@ -57,22 +74,125 @@ if __name__ == '__main__':
     UNIQ_TYPE = int(os.getenv('UNIQ_TYPE'))
     PROCESSES = int(os.getenv('PROCESSES')) if os.getenv('PROCESSES') else os.cpu_count() - 1
     THREADS = int(os.getenv('THREADS')) if os.getenv('THREADS') else os.cpu_count() - 1
-
+    USE_CNN = os.getenv('USE_CNN') == '1'
+    PRELOAD_MODELS = os.getenv('PRELOAD_MODELS') == '1'
+    DETECTION_SIZE = int(os.getenv('DETECTION_SIZE')) if os.getenv('DETECTION_SIZE') else 0
+    DETECTION_FALLBACK = os.getenv('DETECTION_FALLBACK') == '1'
+    PALETTE_BACKEND = os.getenv('PALETTE_BACKEND', 'extcolors')
+    PALETTE_TOLERANCE = int(os.getenv('PALETTE_TOLERANCE')) if os.getenv('PALETTE_TOLERANCE') else 32
+    CNN_UPSAMPLE = int(os.getenv('CNN_UPSAMPLE')) if os.getenv('CNN_UPSAMPLE') else 0
+    EXTRACT_BATCH = int(os.getenv('EXTRACT_BATCH')) if os.getenv('EXTRACT_BATCH') else 1
+    SAVE_IN_WORKERS = os.getenv('SAVE_IN_WORKERS') == '1'
+    PIPELINE = os.getenv('PIPELINE') == '1'
+    PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE')) if os.getenv('PIPELINE_QUEUE_SIZE') else 0
+    INCREMENTAL = os.getenv('INCREMENTAL') == '1'
+    MANIFEST_HASH = os.getenv('MANIFEST_HASH') == '1'
+    CONNECTIONS_PER_HOST = int(os.getenv('CONNECTIONS_PER_HOST')) if os.getenv('CONNECTIONS_PER_HOST') else THREADS
+    PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH')) if os.getenv('PREFETCH_DEPTH') else 1
+    DOWNLOAD_LOG = os.getenv('DOWNLOAD_LOG', 'text')
+    FSYNC_EVERY = int(os.getenv('FSYNC_EVERY')) if os.getenv('FSYNC_EVERY') else 0
+    COMPACT_LOG = os.getenv('COMPACT_LOG') == '1'
+    CURSOR_MODE = os.getenv('CURSOR_MODE', 'none')
+    # requests per second, rates adapt between RATE / 16 and RATE * 4 by default
+    FEED_RATE = float(os.getenv('FEED_RATE')) if os.getenv('FEED_RATE') else 0.5
+    CDN_RATE = float(os.getenv('CDN_RATE')) if os.getenv('CDN_RATE') else THREADS * 2000 / max(sum(DELAY_BEFORE), 1)
+    MAX_RETRIES = int(os.getenv('MAX_RETRIES')) if os.getenv('MAX_RETRIES') else 5
+    SKIP_NEAR_DUPLICATES = os.getenv('SKIP_NEAR_DUPLICATES') == '1'
+    PHASH_DISTANCE = int(os.getenv('PHASH_DISTANCE')) if os.getenv('PHASH_DISTANCE') else 4
+    # e.g. "makeup:2 yellowmakeup:1", sources get downloads proportionally to their weights
+    SOURCE_WEIGHTS = {name: int(weight) for name, weight in
+                      (item.rsplit(':', 1) for item in os.getenv('SOURCE_WEIGHTS', '').split())}
+    OUTPUT = os.getenv('OUTPUT', 'folders')
+    ENCODER = os.getenv('ENCODER', 'png')
+    ENCODER_LEVEL = int(os.getenv('ENCODER_LEVEL')) if os.getenv('ENCODER_LEVEL') else None
+    SHARD_SIZE = int(os.getenv('SHARD_SIZE')) * 1024 * 1024 if os.getenv('SHARD_SIZE') else 256 * 1024 * 1024
+    TRUE_EXTENSION = os.getenv('TRUE_EXTENSION') == '1'
+    MIN_IMAGE_SIDE = int(os.getenv('MIN_IMAGE_SIDE')) if os.getenv('MIN_IMAGE_SIDE') else 0
+    DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE')) if os.getenv('DOWNLOAD_CHUNK_SIZE') else 64 * 1024
+    # e.g. "login2:password2 login3:password3", feed requests are shared with INSTAGRAM_LOGIN account
+    ACCOUNTS = [tuple(item.split(':', 1)) for item in os.getenv('ACCOUNTS', '').split()]
+    ACCOUNT_COOLDOWN = float(os.getenv('ACCOUNT_COOLDOWN')) if os.getenv('ACCOUNT_COOLDOWN') else 60.0
+    METRICS_FILE = os.getenv('METRICS_FILE')
+    METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL')) if os.getenv('METRICS_INTERVAL') else 10.0
+    METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else 0
+    LEASE_SECONDS = float(os.getenv('LEASE_SECONDS')) if os.getenv('LEASE_SECONDS') else 120.0
+    MODELS_ARGS = (USE_CNN, DETECTION_SIZE, DETECTION_FALLBACK, PALETTE_BACKEND, PALETTE_TOLERANCE, CNN_UPSAMPLE)
+
+    if args.coordinator:
+        # coordinator only fills the queue, it does not log in and does not load models
+        os.makedirs(os.path.dirname(args.queue) or '.', exist_ok=True)
+        queue = WorkQueue(args.queue, LEASE_SECONDS)
+        run_coordinator(queue, [hashtag[1:] if hashtag.startswith('#') else hashtag
+                                for hashtag in (args.hashtags or '').split()],
+                        (args.users or '').split(), args.extract)
+        queue.close()
+        exit()
+
+    downloader = Downloader(CONNECTIONS_PER_HOST, chunk_size=DOWNLOAD_CHUNK_SIZE)
+    scheduler = DownloadScheduler(THREADS, SOURCE_WEIGHTS)
+    api = None
+    if ACCOUNTS:
+        api = create_client_pool([(INSTAGRAM_LOGIN, INSTAGRAM_PASSWORD)] + ACCOUNTS, ACCOUNT_COOLDOWN, rate=FEED_RATE)
+    # FEED_RATE is per account, every account of the pool also has its own limiter, so a single source
+    # pinned to one account never gets the rate of all accounts
+    feed_limiter = AdaptiveRateLimiter(FEED_RATE * (len(api) if api else 1), backoff_base=15, backoff_max=300,
+                                       name='feed')
+    cdn_limiter = AdaptiveRateLimiter(CDN_RATE, backoff_base=sum(DELAY_ERROR) / 2000, name='cdn')
     progress_bar = Bar(max=int(IMAGES_NUMBER) if IMAGES_NUMBER else 1)
+    metrics_exporter = MetricsExporter(get_metrics(), METRICS_FILE, METRICS_INTERVAL, METRICS_PORT).start()
+
+    if PRELOAD_MODELS:
+        # forked workers share already loaded model pages with the parent
+        extractors.load_models(*MODELS_ARGS)
 
-    with Pool(processes=PROCESSES) as process_pool:
+    with Pool(processes=PROCESSES, initializer=partial(extractors.init_worker, *MODELS_ARGS)) as process_pool:
 
         print(f"Start downloading on {PROCESSES} processes")
 
-        if args.users:
-            crawler = UsersCrawler(INSTAGRAM_LOGIN, INSTAGRAM_PASSWORD, process_pool, PROCESSES,
-                                   THREADS, DELAY_BEFORE, DELAY_ERROR, UNIQ_TYPE, progress_bar, args.extract,
-                                   IMAGES_NUMBER)
+        worker_id = args.worker_id if args.worker_id else get_worker_id()
+
+        def create_users_crawler() -> UsersCrawler:
+            return UsersCrawler(INSTAGRAM_LOGIN, INSTAGRAM_PASSWORD, process_pool, PROCESSES,
+                                THREADS, DELAY_BEFORE, DELAY_ERROR, UNIQ_TYPE, progress_bar, args.extract,
+                                IMAGES_NUMBER, downloader=downloader, prefetch_depth=PREFETCH_DEPTH,
+                                download_log=DOWNLOAD_LOG, fsync_every=FSYNC_EVERY, compact_log=COMPACT_LOG,
+                                cursor_mode=CURSOR_MODE, feed_limiter=feed_limiter, cdn_limiter=cdn_limiter,
+                                max_retries=MAX_RETRIES, scheduler=scheduler, min_image_side=MIN_IMAGE_SIDE,
+                                true_extension=TRUE_EXTENSION, api=api)
+
+        def create_hashtags_crawler() -> Crawler:
+            return Crawler(INSTAGRAM_LOGIN, INSTAGRAM_PASSWORD, process_pool, PROCESSES, THREADS, DELAY_BEFORE,
+                           DELAY_ERROR, UNIQ_TYPE, progress_bar, args.extract, IMAGES_NUMBER,
+                           batch_size=EXTRACT_BATCH, save_in_workers=SAVE_IN_WORKERS, pipeline=PIPELINE,
+                           pipeline_queue_size=PIPELINE_QUEUE_SIZE, incremental=INCREMENTAL,
+                           manifest_hash=MANIFEST_HASH, downloader=downloader, prefetch_depth=PREFETCH_DEPTH,
+                           download_log=DOWNLOAD_LOG, fsync_every=FSYNC_EVERY, compact_log=COMPACT_LOG,
+                           cursor_mode=CURSOR_MODE, feed_limiter=feed_limiter, cdn_limiter=cdn_limiter,
+                           max_retries=MAX_RETRIES, skip_near_duplicates=SKIP_NEAR_DUPLICATES,
+                           phash_distance=PHASH_DISTANCE, scheduler=scheduler, min_image_side=MIN_IMAGE_SIDE,
+                           true_extension=TRUE_EXTENSION, output=OUTPUT, shard_size=SHARD_SIZE,
+                           encoder=ENCODER, encoder_level=ENCODER_LEVEL, api=api,
+                           node_id=worker_id if args.worker else '')
+
+        if args.worker:
+            def get_crawler(source_type: str):
+                # crawlers are created on first item of their type, so worker without users never needs them
+                new_crawler = create_users_crawler() if source_type == 'user' else create_hashtags_crawler()
+                new_crawler.listener.start()
+                return new_crawler
+
+            worker = Worker(WorkQueue(args.queue, LEASE_SECONDS), get_crawler, worker_id,
+                            extract_batch=PROCESSES * max(EXTRACT_BATCH, 1) * 4, extract_only=args.extract)
+            print(f"Worker {worker.worker_id} is taking work from {args.queue}")
+            worker.run()
+            worker.queue.close()
+            crawler = worker.crawlers.get('hashtag', worker.crawlers.get('user'))
+        elif args.users:
+            crawler = create_users_crawler()
             crawler.listener.start()
             run_users_search(args.users.split(), crawler)
         elif args.hashtags:
-            crawler = Crawler(INSTAGRAM_LOGIN, INSTAGRAM_PASSWORD, process_pool, PROCESSES, THREADS, DELAY_BEFORE,
-                              DELAY_ERROR, UNIQ_TYPE, progress_bar, args.extract, IMAGES_NUMBER)
+            crawler = create_hashtags_crawler()
             crawler.listener.start()
             run_hashtags_search(args.hashtags.split(), crawler)
         else:
@@ -80,5 +200,13 @@ if __name__ == '__main__':
             exit()
 
     progress_bar.finish()
-    if crawler.stage == 1:
+    scheduler.close()
+    downloader.close()
+    metrics_exporter.stop()
+    if crawler is not None and (crawler.stage == 1 or (isinstance(crawler, Crawler) and crawler.pipeline)):
         print('Good:', crawler.good_extract)
+        if isinstance(crawler, Crawler):
+            print(crawler.detection_report())
+            print(crawler.timings_report())
+            if crawler.skip_near_duplicates:
+                print(crawler.duplicates_report())
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os.path
+from threading import Lock
+from typing import List, Optional
+
+
+def get_sha1(path: str) -> str:
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+class ExtractionManifest:
+    # append-only json lines file with one record per processed source image, the last record wins
+    def __init__(self, path: str, version: str, use_hash: bool = False, read_paths: List[str] = None) -> None:
+        self.path = path
+        self.version = version
+        self.use_hash = use_hash
+        self.records = {}
+        self.lock = Lock()
+        # records of other nodes are read from their files, only own file at path is appended
+        for read_path in (read_paths if read_paths else [path]):
+            if not os.path.isfile(read_path):
+                continue
+            with open(read_path) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line could be partially written on crash
+                        continue
+                    self.records[record['file']] = record
+        self.fp = open(path, 'a', buffering=1)
+
+    def get_stat(self, path: str) -> dict:
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def get_source(self, path: str) -> dict:
+        source = self.get_stat(path)
+        if self.use_hash:
+            source['sha1'] = get_sha1(path)
+        return source
+
+    def is_processed(self, path: str) -> bool:
+        record = self.records.get(os.path.basename(path))
+        # photos which failed with an error are tried again on the next run
+        if record is None or record.get('version') != self.version or record.get('outcome') == 'error':
+            return False
+        try:
+            if all(record.get(key) == value for key, value in self.get_stat(path).items()):
+                return True
+            # content is read only when size or mtime changed, e.g. the same photo was copied again
+            return self.use_hash and record.get('sha1') == get_sha1(path)
+        except OSError:
+            return False
+
+    def add(self, path: str, outcome: str) -> None:
+        try:
+            record = self.get_source(path)
+        except OSError:
+            return
+        record.update({'file': os.path.basename(path), 'version': self.version, 'outcome': outcome})
+        with self.lock:
+            self.records[record['file']] = record
+            self.fp.write(json.dumps(record) + '\n')
+
+    def outcome(self, path: str) -> Optional[str]:
+        record = self.records.get(os.path.basename(path))
+        return record.get('outcome') if record else None
+
+    def close(self) -> None:
+        with self.lock:
+            self.fp.close()
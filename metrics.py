@@ -0,0 +1,191 @@
+import json
+import os
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Event
+from time import perf_counter
+from typing import Iterator, Tuple
+
+# latency buckets in seconds, from a cached decode to a throttled feed request
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def get_key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def format_key(key: Tuple[str, tuple], extra: tuple = ()) -> str:
+    name, labels = key
+    labels = labels + extra
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(label, value) for label, value in labels))
+
+
+class Metrics:
+    # counters and latency histograms, worker processes send collected snapshots to be merged in main process
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters = {}
+        # key -> [bucket counts, sum, count], bucket counts are not cumulative
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = get_key(name, labels)
+        bucket = 0
+        while bucket < len(BUCKETS) and value > BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram = self.histograms[key]
+            histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {key: [list(counts), total, count]
+                                   for key, (counts, total, count) in self.histograms.items()}}
+
+    def collect(self) -> dict:
+        # snapshot and reset, workers attach it to every result so nothing is counted twice
+        with self.lock:
+            snapshot = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def reset(self) -> None:
+        self.collect()
+
+    def merge(self, snapshot: dict) -> None:
+        if not snapshot:
+            return
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total, count) in snapshot['histograms'].items():
+                if key not in self.histograms:
+                    self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+                histogram = self.histograms[key]
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def to_json(self) -> str:
+        snapshot = self.snapshot()
+        histograms = {}
+        for key, (counts, total, count) in snapshot['histograms'].items():
+            histograms[format_key(key)] = {'count': count, 'sum': total, 'mean': total / count if count else 0.0,
+                                           'buckets': dict(zip([str(le) for le in BUCKETS] + ['+Inf'], counts))}
+        return json.dumps({'counters': {format_key(key): value for key, value in snapshot['counters'].items()},
+                           'histograms': histograms}, indent=2)
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for key, value in sorted(snapshot['counters'].items()):
+            lines.append('{} {}'.format(format_key(key), value))
+        for key, (counts, total, count) in sorted(snapshot['histograms'].items()):
+            name, labels = key
+            cumulative = 0
+            for le, bucket_count in zip([str(le) for le in BUCKETS] + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append('{} {}'.format(format_key((name + '_bucket', labels), (('le', le),)), cumulative))
+            lines.append('{} {}'.format(format_key((name + '_sum', labels)), total))
+            lines.append('{} {}'.format(format_key((name + '_count', labels)), count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.startswith('/metrics.json'):
+            body, content_type = self.server.metrics.to_json(), 'application/json'
+        elif self.path.startswith('/metrics'):
+            body, content_type = self.server.metrics.to_prometheus(), 'text/plain; version=0.0.4'
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class MetricsExporter:
+    # rewrites metrics file every `interval` seconds (json for .json path, prometheus text otherwise)
+    # and serves /metrics and /metrics.json on localhost when port is set
+    def __init__(self, metrics: 'Metrics', path: str = None, interval: float = 10.0, port: int = 0) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.port = port
+        self.stopped = Event()
+        self.thread = None
+        self.server = None
+
+    def write(self) -> None:
+        if not self.path:
+            return
+        text = self.metrics.to_json() if self.path.endswith('.json') else self.metrics.to_prometheus()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(text)
+        os.replace(tmp_path, self.path)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self) -> 'MetricsExporter':
+        if self.path:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+        if self.port:
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), MetricsHandler)
+            self.server.daemon_threads = True
+            self.server.metrics = self.metrics
+            Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    # one registry per process
+    return _metrics
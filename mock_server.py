@@ -0,0 +1,118 @@
+import json
+import os
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import random
+from threading import Thread, local
+from time import sleep
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # keep-alive connections like the real CDN
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        if self.server.latency:
+            sleep(self.server.latency)
+        if random() < self.server.error_rate:
+            self.send_body(b'', status=503)
+            return
+        url = urlparse(self.path)
+        if url.path.startswith('/cdn/'):
+            self.send_body(self.server.get_image(url.path[len('/cdn/'):]), 'image/jpeg')
+            return
+        if url.path.startswith('/feed/tag/') or url.path.startswith('/feed/user/'):
+            source = url.path.rstrip('/').split('/')[-1]
+            max_id = parse_qs(url.query).get('max_id', [None])[0]
+            self.send_body(json.dumps(self.server.get_feed_page(source, max_id)).encode(), 'application/json')
+            return
+        self.send_body(b'', status=404)
+
+    def send_body(self, body: bytes, content_type: str = 'application/octet-stream', status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    # local stand-in for instagram feeds and CDN, feed pages are served from /feed/tag/<hashtag> and
+    # /feed/user/<username>, images from /cdn/<name>.jpg
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, image_size: int = 200 * 1024,
+                 port: int = 0, images: List[bytes] = None, page_size: int = 50, pages: int = 10) -> None:
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        # fixture images are served round robin by name, random bytes are enough for download benchmarks
+        self.images = images if images else [os.urandom(image_size)]
+        self.page_size = page_size
+        self.pages = pages
+        self.thread = None
+
+    @property
+    def image_body(self) -> bytes:
+        return self.images[0]
+
+    def get_image(self, name: str) -> bytes:
+        return self.images[zlib.crc32(name.encode()) % len(self.images)]
+
+    def get_feed_page(self, source: str, max_id: Optional[str]) -> dict:
+        # the same items as instagram feed_tag and username_feed, every source has `pages` pages
+        page = int(max_id) if max_id else 0
+        items = []
+        for i in range(self.page_size):
+            name = '{}_{}_{}'.format(source, page, i)
+            items.append({'id': name, 'code': name, 'media_type': 1,
+                          'image_versions2': {'candidates': [
+                              {'url': self.image_url(name + '_n'), 'width': 1080, 'height': 1350},
+                              {'url': self.image_url(name + '_s'), 'width': 640, 'height': 800}]}})
+        more_available = page + 1 < self.pages
+        return {'items': items, 'more_available': more_available,
+                'next_max_id': str(page + 1) if more_available else None}
+
+    def url(self, path: str) -> str:
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def image_url(self, name: str) -> str:
+        return self.url('/cdn/{}.jpg'.format(name))
+
+    def start(self) -> 'MockServer':
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class MockClient:
+    # stand-in for instagram_private_api.Client, feed pages are requested from MockServer over http,
+    # so server latency and errors apply to feed requests too
+    def __init__(self, server: MockServer) -> None:
+        self.server = server
+        self.settings = {'uuid': 'mock'}
+        self.sessions = local()
+
+    def get_feed(self, path: str, max_id: Optional[str] = None) -> dict:
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        response = self.sessions.session.get(self.server.url(path), params={'max_id': max_id} if max_id else None)
+        response.raise_for_status()
+        return response.json()
+
+    def feed_tag(self, tag: str, rank_token: str, **kwargs) -> dict:
+        return self.get_feed('/feed/tag/' + tag, kwargs.get('max_id'))
+
+    def username_feed(self, user_name: str, **kwargs) -> dict:
+        return self.get_feed('/feed/user/' + user_name, kwargs.get('max_id'))
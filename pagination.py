@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from queue import Queue, Full
+from threading import Thread, Condition
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from cursors import CursorStore
+
+
+class FeedPrefetcher:
+    # fetches up to depth next feed pages in background while images of the current pages are downloading
+    # fetch_page returns (urls, next_max_id, number of already seen images on the page)
+    # cursor_mode "none" always starts from the head of the feed, "resume" continues from saved cursor,
+    # "topup" scans from the head until already seen images and then continues from saved cursor
+    def __init__(self, fetch_page: Callable[[Optional[str]], Tuple[list, str, int]], depth: int,
+                 is_stopped: Callable[[], bool], cursor: CursorStore = None, cursor_mode: str = 'none') -> None:
+        self.fetch_page = fetch_page
+        self.is_stopped = is_stopped
+        self.cursor = cursor
+        self.cursor_mode = cursor_mode if cursor else 'none'
+        self.pages = Queue(max(depth, 1))
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self) -> 'FeedPrefetcher':
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        try:
+            if self.cursor_mode == 'none':
+                self.paginate(None, checkpoint=False)
+                return
+            has_cursor = self.cursor.next_max_id or self.cursor.exhausted
+            if self.cursor_mode == 'topup' and has_cursor:
+                self.paginate(None, checkpoint=False, until_seen=True)
+            if not has_cursor:
+                self.paginate(None, checkpoint=True)
+            elif not self.cursor.exhausted:
+                self.paginate(self.cursor.next_max_id, checkpoint=True)
+        finally:
+            self.put(None)
+
+    def paginate(self, max_id: Optional[str], checkpoint: bool, until_seen: bool = False) -> None:
+        next_max_id = max_id
+        while next_max_id != '' and not self.is_stopped():
+            urls, next_max_id, seen = self.fetch_page(next_max_id)
+            if self.is_stopped():
+                return
+            # page is checkpointed by its next_max_id when all its downloads are finished
+            self.put((urls, next_max_id if checkpoint else None))
+            if until_seen and seen:
+                return
+
+    def put(self, page: Optional[tuple]) -> None:
+        while True:
+            try:
+                self.pages.put(page, timeout=1)
+                return
+            except Full:
+                if self.is_stopped() and page is not None:
+                    return
+
+    def __iter__(self) -> Iterator[tuple]:
+        while True:
+            page = self.pages.get()
+            if page is None:
+                return
+            yield page
+
+
+def download_pages(thread_pool: ThreadPool, pages: Iterable[tuple], download: Callable,
+                   on_result: Callable, max_pending: int, on_page_done: Callable = None) -> None:
+    # pages are (tasks, token) pairs, on_page_done gets tokens of finished pages in the feed order
+    # next page is taken as soon as pool has free capacity, downloads are not drained on page boundary
+    condition = Condition()
+    pending = [0]
+    remaining = OrderedDict()
+
+    def pop_finished() -> None:
+        while remaining and next(iter(remaining.values()))[0] == 0:
+            _, (_, token) = remaining.popitem(last=False)
+            if on_page_done and token is not None:
+                on_page_done(token)
+
+    def done(index: int, result) -> None:
+        try:
+            on_result(result)
+        finally:
+            failed(index, None)
+
+    def failed(index: int, _) -> None:
+        with condition:
+            pending[0] -= 1
+            remaining[index][0] -= 1
+            pop_finished()
+            condition.notify_all()
+
+    for index, (page, token) in enumerate(pages):
+        with condition:
+            while pending[0] >= max_pending:
+                condition.wait()
+            pending[0] += len(page)
+            remaining[index] = [len(page), token]
+            pop_finished()
+        for task in page:
+            try:
+                thread_pool.apply_async(download, (task,), callback=partial(done, index),
+                                        error_callback=partial(failed, index))
+            except ValueError:
+                # pool is closed on quit
+                failed(index, None)
+
+    with condition:
+        while pending[0] > 0:
+            condition.wait()
@@ -0,0 +1,118 @@
+import glob
+import os.path
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(path: str, hash_size: int = 8) -> int:
+    # difference hash of small grayscale thumbnail, jpeg is decoded in draft mode at reduced size
+    img = Image.open(path)
+    img.draft('L', (hash_size * 8, hash_size * 8))
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    # multi-index hashing: 64-bit hash is split into max_distance + 1 chunks,
+    # so any hash within max_distance matches at least one chunk exactly and only these buckets are checked,
+    # nodes of a distributed run append to own files and read new lines of files matching `shared` every
+    # `sync_interval` seconds
+    def __init__(self, path: str, max_distance: int = 4, bits: int = 64, shared: str = None,
+                 sync_interval: float = 5.0) -> None:
+        self.path = path
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.synced_at = 0.0
+        # read position per file of other nodes
+        self.offsets = {}
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        widths = [bits // chunks + (1 if i < bits % chunks else 0) for i in range(chunks)]
+        self.chunks = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self.chunks.append((shift, (1 << width) - 1))
+        self.tables = [{} for _ in self.chunks]
+        self.names = []
+        self.hashes = {}
+        self.lock = Lock()
+        self.sync()
+        if os.path.isfile(path):
+            with open(path) as fp:
+                self.read_lines(fp.read())
+        self.fp = open(path, 'a', buffering=1)
+
+    def read_lines(self, text: str) -> None:
+        for line in text.splitlines():
+            parts = line.split(' ', 1)
+            if len(parts) == 2 and parts[1].strip() not in self.hashes:
+                try:
+                    self.insert(int(parts[0], 16), parts[1].strip())
+                except ValueError:
+                    continue
+
+    def sync(self) -> None:
+        # only complete lines are read, a line being appended by another node is read on the next sync
+        self.synced_at = monotonic()
+        if not self.shared:
+            return
+        for path in sorted(glob.glob(self.shared)):
+            if os.path.abspath(path) == os.path.abspath(self.path):
+                continue
+            offset = self.offsets.get(path, 0)
+            if os.path.getsize(path) <= offset:
+                continue
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read()
+            end = data.rfind(b'\n') + 1
+            self.offsets[path] = offset + end
+            self.read_lines(data[:end].decode(errors='ignore'))
+
+    def insert(self, image_hash: int, name: str) -> None:
+        index = len(self.names)
+        self.names.append((image_hash, name))
+        self.hashes[name] = image_hash
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault((image_hash >> shift) & mask, []).append(index)
+
+    def find(self, image_hash: int) -> Optional[str]:
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            for index in table.get((image_hash >> shift) & mask, ()):
+                candidate_hash, name = self.names[index]
+                if hamming_distance(image_hash, candidate_hash) <= self.max_distance:
+                    return name
+        return None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.hashes
+
+    def check_and_add(self, image_hash: int, name: str) -> Optional[str]:
+        # only first copies are added, returns name of the first copy for near duplicate
+        with self.lock:
+            if name in self.hashes:
+                return None
+            if self.shared and monotonic() - self.synced_at >= self.sync_interval:
+                self.sync()
+                if name in self.hashes:
+                    return None
+            duplicate = self.find(image_hash)
+            if duplicate is None:
+                self.insert(image_hash, name)
+                self.fp.write('{:016x} {}\n'.format(image_hash, name))
+            return duplicate
+
+    def close(self) -> None:
+        with self.lock:
+            self.fp.close()
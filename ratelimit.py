@@ -0,0 +1,71 @@
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional
+
+from metrics import get_metrics
+
+
+class AdaptiveRateLimiter:
+    # token bucket shared by all threads, rate (requests per second) is adapted AIMD style:
+    # every success adds `increase`, every throttle multiplies by `decrease` at most once per `cooldown` seconds
+    # rate 0 or less is unlimited, requests are not paced but backoff after errors still applies
+    def __init__(self, rate: float, min_rate: float = None, max_rate: float = None, burst: int = 1,
+                 increase: float = None, decrease: float = 0.5, cooldown: float = 1.0,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, name: str = '') -> None:
+        # name labels throttle and backoff sleeps in metrics
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate if min_rate else rate / 16
+        self.max_rate = max_rate if max_rate else rate * 4
+        self.burst = burst
+        self.increase = increase if increase else rate / 100
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens = burst
+        self.updated = monotonic()
+        self.last_decrease = 0.0
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        # reserves a token, waits outside of the lock while it is refilled
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            get_metrics().observe('throttle_seconds', wait, limiter=self.name)
+            sleep(wait)
+
+    def success(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self) -> None:
+        with self.lock:
+            now = monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def report(self, status: Optional[int]) -> bool:
+        # returns True when request should be retried
+        if status is None or status == 429 or status >= 500:
+            self.throttled()
+            return True
+        self.success()
+        return False
+
+    def backoff(self, attempt: int) -> None:
+        # exponential backoff with equal jitter
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = delay / 2 + uniform(0, delay / 2)
+        get_metrics().observe('backoff_seconds', delay, limiter=self.name)
+        sleep(delay)
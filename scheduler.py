@@ -0,0 +1,117 @@
+from collections import OrderedDict, deque
+from threading import Thread, Condition, Lock
+from typing import Callable
+
+
+class SourceHandle:
+    # ThreadPool-like apply_async for tasks of one source
+    def __init__(self, scheduler: 'DownloadScheduler', source: str) -> None:
+        self.scheduler = scheduler
+        self.source = source
+
+    def apply_async(self, func: Callable, args: tuple = (), callback: Callable = None,
+                    error_callback: Callable = None) -> None:
+        self.scheduler.submit(self.source, func, args, callback, error_callback)
+
+
+class DownloadScheduler:
+    # one bounded set of worker threads for all hashtags and users,
+    # sources get tasks by weighted round-robin: `weight` tasks in a row, then the next source
+    def __init__(self, workers: int, weights: dict = None) -> None:
+        self.default_weights = weights if weights else {}
+        self.queues = OrderedDict()
+        self.weights = {}
+        self.credits = {}
+        self.closed = False
+        self.condition = Condition()
+        # callbacks are called one at a time like in ThreadPool
+        self.callback_lock = Lock()
+        self.threads = [Thread(target=self.work, daemon=True) for _ in range(max(workers, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def source(self, name: str, weight: int = None) -> SourceHandle:
+        with self.condition:
+            if name not in self.queues:
+                self.queues[name] = deque()
+                self.weights[name] = max(weight if weight else self.default_weights.get(name, 1), 1)
+                self.credits[name] = self.weights[name]
+        return SourceHandle(self, name)
+
+    def submit(self, source: str, func: Callable, args: tuple, callback: Callable = None,
+               error_callback: Callable = None) -> None:
+        with self.condition:
+            if self.closed:
+                raise ValueError('Scheduler is closed')
+            if source not in self.queues:
+                self.queues[source] = deque()
+                self.weights[source] = max(self.default_weights.get(source, 1), 1)
+                self.credits[source] = self.weights[source]
+            self.queues[source].append((func, args, callback, error_callback))
+            self.condition.notify()
+
+    def next_task(self) -> tuple:
+        # called with condition held
+        for _ in range(len(self.queues)):
+            source, queue = next(iter(self.queues.items()))
+            if queue:
+                self.credits[source] -= 1
+                task = queue.popleft()
+                if self.credits[source] <= 0:
+                    self.rotate(source)
+                return task
+            self.rotate(source)
+        return None
+
+    def rotate(self, source: str) -> None:
+        self.queues.move_to_end(source)
+        self.credits[source] = self.weights[source]
+
+    def work(self) -> None:
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    task = self.next_task()
+            func, args, callback, error_callback = task
+            try:
+                result = func(*args)
+            except Exception as e:
+                self.call(error_callback, e)
+                continue
+            self.call(callback, result)
+
+    def call(self, callback: Callable, value) -> None:
+        if callback is None:
+            return
+        with self.callback_lock:
+            try:
+                callback(value)
+            except Exception:
+                pass
+
+    def pending(self) -> int:
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def close(self) -> None:
+        # finishes queued tasks and stops workers
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def terminate(self) -> None:
+        # drops queued tasks, their error callbacks are called so waiting sources are released
+        with self.condition:
+            self.closed = True
+            dropped = [task for queue in self.queues.values() for task in queue]
+            for queue in self.queues.values():
+                queue.clear()
+            self.condition.notify_all()
+        for _, _, _, error_callback in dropped:
+            self.call(error_callback, ValueError('Scheduler is terminated'))
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip('instagram_private_api')
+
+from clients import AccountsCoolingDown, ClientPool, StubClient
+
+
+def get_pool(*fail_every: int, cooldown: float = 60.0) -> ClientPool:
+    return ClientPool([('account{}'.format(i), StubClient('account{}'.format(i), fail_every=fail))
+                       for i, fail in enumerate(fail_every)], cooldown=cooldown, cooldown_max=900.0)
+
+
+def test_source_sticks_to_account():
+    pool = get_pool(0, 0)
+    accounts = {pool.feed_tag('cats', 'token')['account'] for _ in range(5)}
+    assert len(accounts) == 1
+    # the second source goes to the account with fewer sources
+    assert pool.feed_tag('dogs', 'token')['account'] not in accounts
+
+
+def test_failed_request_goes_to_next_account():
+    pool = get_pool(1, 0)
+    page = pool.feed_tag('cats', 'token')
+    assert page['account'] == 'account1'
+    assert pool.accounts[0].failures == 1
+    # the source stays on the healthy account
+    assert pool.feed_tag('cats', 'token', max_id=page['next_max_id'])['account'] == 'account1'
+
+
+def test_cooldown_doubles_with_failures():
+    pool = get_pool(0, cooldown=10.0)
+    account = pool.accounts[0]
+    for failures in range(3):
+        pool.failure(account)
+        assert account.cooldown_until - account.throttled_at == pytest.approx(10.0 * 2 ** failures)
+    pool.success(account)
+    assert account.failures == 0
+
+
+def test_all_accounts_cooling_down_keeps_last_error():
+    pool = get_pool(1, 1)
+    with pytest.raises(AccountsCoolingDown) as info:
+        pool.feed_tag('cats', 'token')
+    assert 'throttled' in str(info.value.__cause__)
+    assert all(account.cooldown_until > 0 for account in pool.accounts)
@@ -4,18 +4,24 @@ import os.path
 import re
 import ssl
 from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
-from random import randint
-from time import sleep
+from time import perf_counter
+from threading import Lock
 from typing import Optional, Union, List, Tuple
 
 import pynput
-import requests
-from PIL import Image
 from instagram_private_api import Client, ClientCookieExpiredError, ClientLoginRequiredError
 from progress.bar import Bar
 
 import extractors
+from dedup import DedupIndex
+from cursors import CursorStore
+from download_log import open_download_log
+from downloader import Downloader
+from pagination import FeedPrefetcher, download_pages
+from ratelimit import AdaptiveRateLimiter
+from scheduler import DownloadScheduler
+from metrics import get_metrics
+from decoding import LazyImage, IMAGE_EXTENSIONS, sniff_file, with_true_extension
 
 
 class UsersCrawler:
@@ -26,28 +32,36 @@ class UsersCrawler:
 
     def __init__(self, login: str, password: str, process_pool: Pool, processes: int,
                  threads: int, delay_before: tuple, delay_error: tuple, uniq_type: int, progress_bar: Bar,
-                 extractor_stage: int = False, images_number: int = None) -> None:
+                 extractor_stage: int = False, images_number: int = None,
+                 downloader: Downloader = None, prefetch_depth: int = 1, download_log: str = 'text',
+                 fsync_every: int = 0, compact_log: bool = False, cursor_mode: str = 'none',
+                 feed_limiter: AdaptiveRateLimiter = None, cdn_limiter: AdaptiveRateLimiter = None,
+                 max_retries: int = 5, scheduler: DownloadScheduler = None, min_image_side: int = 0,
+                 true_extension: bool = False, api: Client = None) -> None:
         self.listener = pynput.keyboard.Listener(on_press=self.on_press)
         ssl._create_default_https_context = ssl._create_unverified_context
         device_id = None
 
+        # api is passed by benchmarks with mock feed, otherwise logged in client is created
+        self.api = api
         try:
-            os.makedirs('sessions', exist_ok=True)
-            session_file = 'sessions/' + login + '.dat'
-            if not os.path.isfile(session_file):
-                self.api = Client(login, password, on_login=lambda x: self.on_login(x, session_file))
-            else:
-                with open(session_file) as file_data:
-                    cached_settings = json.load(file_data, object_hook=UsersCrawler.from_json)
-                device_id = cached_settings.get('device_id')
-                self.api = Client(login, password, settings=cached_settings)
+            if self.api is None:
+                os.makedirs('sessions', exist_ok=True)
+                session_file = 'sessions/' + login + '.dat'
+                if not os.path.isfile(session_file):
+                    self.api = Client(login, password, on_login=lambda x: self.on_login(x, session_file))
+                else:
+                    with open(session_file) as file_data:
+                        cached_settings = json.load(file_data, object_hook=UsersCrawler.from_json)
+                    device_id = cached_settings.get('device_id')
+                    self.api = Client(login, password, settings=cached_settings)
 
         except (ClientCookieExpiredError, ClientLoginRequiredError) as e:
             self.api = Client(login, password, device_id=device_id, on_login=lambda x: self.on_login(session_file))
 
         self.process_pool = process_pool
         # self.thread_pool = thread_pool
-        self.images = {}
+        self.dedup = DedupIndex(uniq_type)
         self.extractor_stage = extractor_stage
         self.extractor_stage_printed = False
         self.downloading_stage_printed = False
@@ -66,6 +80,30 @@ class UsersCrawler:
         self.post_codes = []
         self.image_ids = []
         self.progress_bar = progress_bar
+        self.downloader = downloader if downloader else Downloader()
+        self.prefetch_depth = prefetch_depth
+        self.download_log = download_log
+        self.fsync_every = fsync_every
+        self.compact_log = compact_log
+        self.cursor_mode = cursor_mode
+        # limiters are shared by all threads, default cdn rate is the same as with delay_before sleeps
+        self.feed_limiter = feed_limiter if feed_limiter else AdaptiveRateLimiter(0.5, backoff_base=15,
+                                                                                 backoff_max=300, name='feed')
+        self.cdn_limiter = cdn_limiter if cdn_limiter else AdaptiveRateLimiter(
+            threads * 2000 / max(sum(delay_before), 1), backoff_base=sum(delay_error) / 2000, name='cdn')
+        self.max_retries = max_retries
+        # all sources share one scheduler, so there are `threads` downloads at most whatever number of sources
+        self.scheduler = scheduler if scheduler else DownloadScheduler(threads)
+        # images downloaded or being downloaded per source, counted while IMAGES_NUMBER is set
+        self.downloaded = {}
+        self.quota_lock = Lock()
+        self.active_sources = set()
+        # sources whose work queue lease was taken over by another node, they stop like on q
+        self.lost_sources = set()
+        # 0 downloads the largest candidate
+        self.min_image_side = min_image_side
+        # downloads are saved as .png by default whatever CDN returns
+        self.true_extension = true_extension
 
     @staticmethod
     def on_login(api: Client, new_settings_file: str) -> None:
@@ -92,27 +130,46 @@ class UsersCrawler:
             'image_versions2') and 'url' in \
                image.get('image_versions2').get('candidates')[0]
 
-    def get_image_urls(self, username: str, max_id: str = None) -> Tuple[list, str]:
+    @staticmethod
+    def select_candidate(candidates: list, min_side: int = 0) -> dict:
+        # the smallest candidate with shorter side not less than min_side, candidates[0] is the largest
+        if not min_side:
+            return candidates[0]
+        suitable = [candidate for candidate in candidates
+                    if 'url' in candidate and min(candidate.get('width', 0), candidate.get('height', 0)) >= min_side]
+        if not suitable:
+            return candidates[0]
+        return min(suitable, key=lambda candidate: candidate.get('width', 0) * candidate.get('height', 0))
+
+    def get_image_urls(self, username: str, max_id: str = None) -> Tuple[list, str, int]:
         result = []
+        seen = 0
         next_max_id = ''
         data = None
+        attempt = 0
         while data is None:
             if self.terminate or self.stage != 0:
-                return [], ''
+                return [], '', 0
             if self.images_number and self.progress_bar.index >= self.images_number:
                 self.stage = 1
             try:
-                data = self.api.username_feed(username, max_id=max_id)
+                self.feed_limiter.acquire()
+                with get_metrics().timer('feed_request_seconds'):
+                    data = self.api.username_feed(username, max_id=max_id)
+                self.feed_limiter.success()
             except Exception as e:
                 print(e)
-                sleep(randint(15, 60))
+                get_metrics().inc('feed_errors_total')
+                self.feed_limiter.throttled()
+                self.feed_limiter.backoff(attempt)
+                attempt += 1
         if 'items' in data:
             if 'more_available' in data and data.get('more_available') and 'next_max_id' in data:
                 next_max_id = data.get('next_max_id')
 
             for e in data.get('items'):
                 if self.terminate or self.stage != 0:
-                    return [], ''
+                    return [], '', 0
                 if self.images_number and self.progress_bar.index >= self.images_number:
                     self.stage = 1
                 if not ('media_type' in e and 'code' in e and 'id' in e):
@@ -122,12 +179,16 @@ class UsersCrawler:
                 if media_type == 1:
                     if not UsersCrawler.check_image_fields(e):
                         continue
-                    image_url = e.get('image_versions2').get('candidates')[0].get('url')
-                    filename = self.get_id_from_url(image_url)
-                    if not self.is_filename_uniq(filename, username, self.uniq_type):
+                    candidates = e.get('image_versions2').get('candidates')
+                    # dedup is keyed on the largest rendition whatever candidate is downloaded
+                    filename = self.get_id_from_url(candidates[0].get('url'))
+                    image_url = UsersCrawler.select_candidate(candidates, self.min_image_side).get('url')
+                    if not self.dedup.claim(filename, username):
+                        # top-up stops on images of this source only, not on ones of other sources with UNIQ_TYPE=1
+                        if self.dedup.is_claimed(filename, username):
+                            seen += 1
                         continue
-                    self.images[username] += [filename]
-                    result += [image_url]
+                    result += [[image_url, filename]]
 
                 elif media_type == 8:
                     if 'carousel_media' not in e:
@@ -137,23 +198,21 @@ class UsersCrawler:
                             continue
                         if ce.get('media_type') != 1 or not UsersCrawler.check_image_fields(ce):
                             continue
-                        image_url = ce.get('image_versions2').get('candidates')[0].get('url')
-                        filename = self.get_id_from_url(image_url)
-                        if not self.is_filename_uniq(filename, username, self.uniq_type):
+                        candidates = ce.get('image_versions2').get('candidates')
+                        # dedup is keyed on the largest rendition whatever candidate is downloaded
+                        filename = self.get_id_from_url(candidates[0].get('url'))
+                        image_url = UsersCrawler.select_candidate(candidates, self.min_image_side).get('url')
+                        if not self.dedup.claim(filename, username):
+                            # top-up stops on images of this source only, not on ones of other sources with UNIQ_TYPE=1
+                            if self.dedup.is_claimed(filename, username):
+                                seen += 1
                             continue
-                        self.images[username] += [filename]
-                        result += [image_url]
-        return result, next_max_id
-
-    def is_filename_uniq(self, filename: str, username: str, uniq_type: int = 0) -> bool:
-        if uniq_type == 0:
-            return filename not in self.images[username]
-        if uniq_type == 1:
-            images = []
-            for _, value in self.images.items():
-                images += value
-            return filename not in images
-        return True
+                        result += [[image_url, filename]]
+        # dedup hit rate is seen / (new + seen)
+        get_metrics().inc('feed_pages_total')
+        get_metrics().inc('feed_items_total', len(result), result='new')
+        get_metrics().inc('feed_items_total', seen, result='seen')
+        return result, next_max_id, seen
 
     def process(self, username: str) -> None:
         for folder in self.folders:
@@ -166,25 +225,33 @@ class UsersCrawler:
         if not self.downloading_stage_printed:
             self.downloading_stage_print()
 
-        self.images[username] = []
-        if os.path.isfile(self.base_path + username + '/downloaded_images.txt'):
-            with open(self.base_path + username + '/downloaded_images.txt', 'r') as fp:
-                self.images[username] = fp.read().split('\n')
-        next_max_id = None
-        fp = open(self.base_path + username + '/downloaded_images.txt', 'w')
-        fp.write('\n'.join(self.images[username]))
-        thread_pool = ThreadPool(self.threads)
-        while (not self.terminate) and next_max_id != '' and self.stage == 0:
-            res = thread_pool.apply_async(self.get_image_urls, (username, next_max_id))
-            urls, next_max_id = res.get()
-            urls = [[username, url] for url in urls]
-            results = thread_pool.imap_unordered(self.save_from_url, urls)
-            for result in results:
-                if result:
-                    fp.write(result + '\n')
-                    if self.stage == 0:
-                        self.progress_bar.next()
-        fp.close()
+        download_log = open_download_log(self.base_path + username, self.download_log, self.fsync_every)
+        if self.compact_log:
+            download_log.compact(self.base_path + username + self.full_images_path)
+        self.dedup.add(username, download_log.load())
+        thread_pool = self.scheduler.source(username)
+        self.downloaded.setdefault(username, 0)
+        self.active_sources.add(username)
+
+        def on_result(result: Optional[str]) -> None:
+            if result:
+                download_log.append(result)
+                if self.stage == 0:
+                    self.progress_bar.next()
+
+        def on_page_done(next_max_id: str) -> None:
+            # images of stopped crawl are not downloaded, so their pages are not checkpointed
+            if not self.is_source_stopped(username):
+                cursor.save(next_max_id)
+
+        cursor = CursorStore(self.base_path + username + '/cursor.json')
+        prefetcher = FeedPrefetcher(lambda max_id: self.get_image_urls(username, max_id), self.prefetch_depth,
+                                    lambda: self.is_source_stopped(username), cursor, self.cursor_mode).start()
+        pages = (([[username, url, filename] for url, filename in urls], next_max_id)
+                 for urls, next_max_id in prefetcher)
+        download_pages(thread_pool, pages, self.save_from_url, on_result, self.threads, on_page_done)
+        self.active_sources.discard(username)
+        download_log.close()
         if self.stage == 1:
             return self.start_extractor(username)
 
@@ -225,45 +292,118 @@ class UsersCrawler:
         self.progress_bar.next(-1)
 
     def save_from_url(self, data: List[str]) -> Optional[str]:
-        username, url = data
-        filename = self.get_id_from_url(url)
+        username, url, filename = data
         response = None
-        if self.terminate or self.stage != 0:
+        if self.is_source_stopped(username):
+            self.dedup.release(filename, username)
             return
         if self.images_number and self.progress_bar.index >= self.images_number:
+            self.dedup.release(filename, username)
             self.stage = 1
             self.extractor_stage_print()
             return
+        if not self.reserve_quota(username):
+            self.dedup.release(filename, username)
+            return
+        started = perf_counter()
+        size = 0
         with open(self.base_path + username + self.full_images_path + filename, 'wb') as handle:
-            while not response:
+            attempt = 0
+            while response is None:
+                if self.terminate:
+                    self.cancel_download(username, filename)
+                    return
                 try:
-                    sleep(randint(*self.delay_before) / 1000)
-                    response = requests.get(url, stream=True)
+                    self.cdn_limiter.acquire()
+                    response = self.downloader.get(url)
                 except Exception:
-                    sleep(randint(*self.delay_error) / 1000)
-            if not response.ok:
-                return
-            for block in response.iter_content(1024):
-                if self.terminate or self.stage != 0:
-                    os.remove(self.base_path + username + self.full_images_path + filename)
-                    return
-                if self.images_number and self.progress_bar.index >= self.images_number:
-                    os.remove(self.base_path + username + self.full_images_path + filename)
-                    self.stage = 1
-                    self.extractor_stage_print()
+                    self.cdn_limiter.report(None)
+                    if attempt >= self.max_retries:
+                        self.cancel_download(username, filename)
+                        return
+                    self.cdn_limiter.backoff(attempt)
+                    attempt += 1
+                    continue
+                # 429 and 5xx are retried with backoff, other errors are not
+                if self.cdn_limiter.report(response.status_code) and attempt < self.max_retries:
+                    response.close()
+                    response = None
+                    self.cdn_limiter.backoff(attempt)
+                    attempt += 1
+            # closing response returns connection to the pool
+            with response:
+                if not response.ok:
+                    get_metrics().inc('download_errors_total')
+                    self.cancel_download(username, filename)
                     return
-                if not block:
-                    break
-                handle.write(block)
+                for block in self.downloader.iter_content(response):
+                    if self.terminate or self.stage != 0:
+                        self.cancel_download(username, filename)
+                        return
+                    if self.images_number and self.progress_bar.index >= self.images_number:
+                        self.cancel_download(username, filename)
+                        self.stage = 1
+                        self.extractor_stage_print()
+                        return
+                    if not block:
+                        break
+                    handle.write(block)
+                    size += len(block)
+        get_metrics().observe('download_seconds', perf_counter() - started)
+        get_metrics().inc('downloads_total')
+        get_metrics().inc('download_bytes_total', size)
+        if self.true_extension:
+            # log and dedup keep .png name, so the setting can be switched between runs
+            path = self.base_path + username + self.full_images_path + filename
+            os.replace(path, with_true_extension(path, sniff_file(path)))
         return filename
 
+    def set_sources(self, sources: List[str]) -> None:
+        # all sources of the run share IMAGES_NUMBER from the start, so the first started source
+        # does not take the whole quota before the others are registered
+        self.active_sources.update(sources)
+
+    def is_over_quota(self, username: str) -> bool:
+        # IMAGES_NUMBER is shared equally between sources which are still downloading
+        if not self.images_number or not self.active_sources:
+            return False
+        quota = -(-self.images_number // len(self.active_sources))
+        return self.downloaded.get(username, 0) >= quota
+
+    def reserve_quota(self, username: str) -> bool:
+        # a download takes its place in IMAGES_NUMBER before it starts and gives it back when cancelled,
+        # so downloads in flight never take a source or the whole run over the budget
+        if not self.images_number:
+            return True
+        with self.quota_lock:
+            if self.is_over_quota(username) or sum(self.downloaded.values()) >= self.images_number:
+                return False
+            self.downloaded[username] = self.downloaded.get(username, 0) + 1
+            return True
+
+    def release_quota(self, username: str) -> None:
+        if not self.images_number:
+            return
+        with self.quota_lock:
+            self.downloaded[username] -= 1
+
+    def is_source_stopped(self, username: str) -> bool:
+        return (self.terminate or self.stage != 0 or self.is_over_quota(username)
+                or username in self.lost_sources)
+
+    def cancel_download(self, username: str, filename: str) -> None:
+        # removes partial file and gives the claim back, so the image is not lost for next runs
+        os.remove(self.base_path + username + self.full_images_path + filename)
+        self.dedup.release(filename, username)
+        self.release_quota(username)
+
     def get_id_from_url(self, url: str) -> str:
         return re.search(r'[\w-]+\.jpg', url).group(0).replace('.jpg', '.png')
 
     def start_extractor(self, hashtag: str) -> None:
         paths = []
         for filename in os.listdir(self.base_path + hashtag + self.full_images_path):
-            if not filename.endswith('.png'):
+            if not filename.endswith(IMAGE_EXTENSIONS):
                 continue
             paths += [self.base_path + hashtag + self.full_images_path + filename]
 
@@ -280,15 +420,18 @@ class UsersCrawler:
             if not images:
                 continue
             for i in range(len(images)):
-                image_filename = path.split('/')[-1]
+                image_filename = os.path.splitext(os.path.basename(path))[0] + '.png'
                 images[i].save(self.base_path + hashtag + self.folders[i] + image_filename)
             self.good_extract += 1
 
 
 def extract(path: str) -> Tuple[str, list]:
-    img = Image.open(path)
     try:
-        images = extractors.extractor(img)
+        image = LazyImage(path)
+    except Exception:
+        return path, []
+    try:
+        images = extractors.extractor(image)
         if images is None:
             return path, []
         # number of folders without "full" folder
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+from collections import namedtuple
+from threading import Lock, Thread, Event
+from time import time
+from typing import Callable, List, Iterable, Tuple
+
+WorkItem = namedtuple('WorkItem', ['id', 'kind', 'key', 'payload'])
+
+
+class WorkQueue:
+    # lease based queue in sqlite on storage shared by all nodes, an item is leased by one worker for
+    # lease_seconds and extended by heartbeats, items of dead workers are leased again when lease expires.
+    # wall clock is compared between nodes, so their clocks have to be synchronized
+    def __init__(self, path: str, lease_seconds: float = 120.0, max_attempts: int = 5) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = Lock()
+        # autocommit mode with explicit transactions, rollback journal because WAL needs shared memory
+        # and does not work over network file systems
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS items ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL UNIQUE, '
+                                'payload TEXT NOT NULL, state TEXT NOT NULL, owner TEXT, '
+                                'lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, '
+                                'updated REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS items_state ON items (kind, state, lease_until)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+
+    def transaction(self, statements: Iterable[Tuple[str, tuple]]) -> None:
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, params in statements:
+                self.connection.execute(sql, params)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def put(self, kind: str, items: List[Tuple[str, dict]], reopen: bool = False) -> None:
+        # items are (key, payload), existing keys are kept as is, so nothing is queued twice,
+        # reopen puts done and failed items back to pending with payload of the new run
+        now = time()
+        if reopen:
+            sql = ('INSERT INTO items (kind, key, payload, state, updated) VALUES (?, ?, ?, \'pending\', ?) '
+                   'ON CONFLICT(key) DO UPDATE SET state = \'pending\', owner = NULL, lease_until = 0, attempts = 0, '
+                   'payload = excluded.payload, updated = excluded.updated WHERE state IN (\'done\', \'failed\')')
+        else:
+            sql = 'INSERT OR IGNORE INTO items (kind, key, payload, state, updated) VALUES (?, ?, ?, \'pending\', ?)'
+        with self.lock:
+            self.transaction((sql, (kind, key, json.dumps(payload), now)) for key, payload in items)
+
+    def lease(self, worker: str, kind: str, limit: int = 1) -> List[WorkItem]:
+        with self.lock:
+            now = time()
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.expire(now)
+                rows = self.connection.execute(
+                    'SELECT id, kind, key, payload FROM items WHERE kind = ? AND (state = \'pending\' OR '
+                    '(state = \'leased\' AND lease_until < ?)) ORDER BY id LIMIT ?', (kind, now, limit)).fetchall()
+                self.connection.executemany(
+                    'UPDATE items SET state = \'leased\', owner = ?, lease_until = ?, attempts = attempts + 1, '
+                    'updated = ? WHERE id = ?', ((worker, now + self.lease_seconds, now, row[0]) for row in rows))
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        return [WorkItem(row[0], row[1], row[2], json.loads(row[3])) for row in rows]
+
+    def expire(self, now: float) -> None:
+        # leases of dead workers which already took max_attempts are not given again
+        self.connection.execute('UPDATE items SET state = \'failed\', owner = NULL, updated = ? '
+                                'WHERE state = \'leased\' AND lease_until < ? AND attempts >= ?',
+                                (now, now, self.max_attempts))
+
+    def heartbeat(self, worker: str, ids: List[int]) -> List[int]:
+        # extends leases, returns ids which are still owned by worker
+        with self.lock:
+            now = time()
+            statements = [('INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)', (worker, now))]
+            statements += [('UPDATE items SET lease_until = ? WHERE id = ? AND owner = ? AND state = \'leased\'',
+                            (now + self.lease_seconds, item_id, worker)) for item_id in ids]
+            self.transaction(statements)
+            return [row[0] for row in self.select_owned(worker, ids)]
+
+    def select_owned(self, worker: str, ids: List[int]) -> list:
+        if not ids:
+            return []
+        placeholders = ','.join('?' * len(ids))
+        return self.connection.execute('SELECT id FROM items WHERE owner = ? AND state = \'leased\' AND id IN ({})'
+                                       .format(placeholders), [worker] + list(ids)).fetchall()
+
+    def update_owned(self, worker: str, ids: List[int], assignments: str) -> int:
+        # only current owner can finish an item, worker whose lease expired is fenced off
+        if not ids:
+            return 0
+        with self.lock:
+            placeholders = ','.join('?' * len(ids))
+            cursor = self.connection.execute(
+                'UPDATE items SET {}, updated = ? WHERE owner = ? AND state = \'leased\' AND id IN ({})'.format(
+                    assignments, placeholders), [time(), worker] + list(ids))
+            return cursor.rowcount
+
+    def complete(self, worker: str, ids: List[int]) -> int:
+        return self.update_owned(worker, ids, 'state = \'done\', lease_until = 0')
+
+    def release(self, worker: str, ids: List[int]) -> int:
+        # gives back leased items which were not started, it is not counted as an attempt
+        return self.update_owned(worker, ids, 'state = \'pending\', owner = NULL, lease_until = 0, '
+                                              'attempts = attempts - 1')
+
+    def fail(self, worker: str, ids: List[int]) -> int:
+        return self.update_owned(worker, ids, 'state = CASE WHEN attempts >= {} THEN \'failed\' ELSE \'pending\' END, '
+                                              'owner = NULL, lease_until = 0'.format(int(self.max_attempts)))
+
+    def counts(self) -> dict:
+        # {kind: {state: count}}, expired leases are counted as pending
+        with self.lock:
+            now = time()
+            rows = self.connection.execute(
+                'SELECT kind, CASE WHEN state = \'leased\' AND lease_until < ? THEN \'pending\' ELSE state END, '
+                'COUNT(*) FROM items GROUP BY 1, 2', (now,)).fetchall()
+        counts = {}
+        for kind, state, count in rows:
+            counts.setdefault(kind, {})[state] = count
+        return counts
+
+    def is_drained(self, kind: str = None) -> bool:
+        for items_kind, states in self.counts().items():
+            if kind and items_kind != kind:
+                continue
+            if states.get('pending') or states.get('leased'):
+                return False
+        return True
+
+    def workers(self, alive_seconds: float = None) -> List[str]:
+        alive_seconds = alive_seconds if alive_seconds else self.lease_seconds
+        with self.lock:
+            rows = self.connection.execute('SELECT id FROM workers WHERE heartbeat >= ?',
+                                           (time() - alive_seconds,)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class Heartbeat:
+    # extends leases of items held by worker every interval seconds while they are processed,
+    # on_lost is called from heartbeat thread with ids which were leased by another worker meanwhile
+    def __init__(self, queue: WorkQueue, worker: str, interval: float = None,
+                 on_lost: Callable[[set], None] = None) -> None:
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval if interval else queue.lease_seconds / 3
+        self.on_lost = on_lost
+        self.ids = set()
+        self.lost = set()
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self) -> 'Heartbeat':
+        self.thread.start()
+        return self
+
+    def add(self, ids: List[int]) -> None:
+        with self.lock:
+            self.ids.update(ids)
+
+    def remove(self, ids: List[int]) -> None:
+        with self.lock:
+            self.ids.difference_update(ids)
+
+    def beat(self) -> None:
+        with self.lock:
+            ids = list(self.ids)
+        owned = set(self.queue.heartbeat(self.worker, ids))
+        with self.lock:
+            # items leased by another worker after expiration, their results are not completed
+            lost = set(ids) - owned - self.lost
+            self.lost.update(lost)
+        if lost and self.on_lost:
+            self.on_lost(lost)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except sqlite3.Error:
+                # shared storage is busy, lease is still valid until next beat
+                continue
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,243 @@
+import json
+import mmap
+import os.path
+import tarfile
+from io import BytesIO
+from threading import Lock
+from time import time
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+
+class PngEncoder:
+    extension = '.png'
+
+    def __init__(self, level: int = None) -> None:
+        # zlib level 0-9, pillow default is 6
+        self.level = 6 if level is None else level
+
+    def encode(self, image: Image.Image) -> bytes:
+        buffer = BytesIO()
+        image.save(buffer, format='PNG', compress_level=self.level)
+        return buffer.getvalue()
+
+
+class WebpEncoder:
+    extension = '.webp'
+
+    def __init__(self, level: int = None) -> None:
+        # lossless webp, level is method 0-6 trading speed for size
+        self.level = 4 if level is None else level
+
+    def encode(self, image: Image.Image) -> bytes:
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP', lossless=True, method=self.level)
+        return buffer.getvalue()
+
+
+class NpyEncoder:
+    # uncompressed BGRA uint8 array for training pipelines, np.load gives (height, width, 4) array
+    extension = '.npy'
+
+    def __init__(self, level: int = None) -> None:
+        self.level = level
+
+    def encode(self, image: Image.Image) -> bytes:
+        buffer = BytesIO()
+        np.save(buffer, np.ascontiguousarray(np.asarray(image.convert('RGBA'))[:, :, [2, 1, 0, 3]]))
+        return buffer.getvalue()
+
+
+ENCODERS = {'png': PngEncoder, 'webp': WebpEncoder, 'npy': NpyEncoder}
+
+
+def get_encoder(name: str = 'png', level: int = None):
+    if name not in ENCODERS:
+        raise ValueError('Unknown encoder {}, expected one of {}'.format(name, ', '.join(ENCODERS)))
+    return ENCODERS[name](level)
+
+
+def encode_images(images: list, encoder=None) -> List[bytes]:
+    # images which are already encoded in worker processes are passed as is
+    encoder = encoder or PngEncoder()
+    return [image if isinstance(image, bytes) else encoder.encode(image) for image in images]
+
+
+def decode_image(data: bytes, extension: str) -> Union[Image.Image, np.ndarray]:
+    if extension == NpyEncoder.extension:
+        return np.load(BytesIO(data))
+    return Image.open(BytesIO(data))
+
+
+def get_component(folder: str) -> str:
+    # '/left_eye/' is stored as 'left_eye' component of a sample
+    return folder.strip('/')
+
+
+class FolderWriter:
+    # default layout, every crop is a separate file in its folder
+    def __init__(self, output_path: str, folders: List[str], encoder=None) -> None:
+        self.output_path = output_path
+        self.folders = folders
+        self.encoder = encoder or PngEncoder()
+
+    def write(self, name: str, images: list) -> None:
+        # write to temporary file and rename, so folders never contain partially written images
+        filename = os.path.splitext(name)[0] + self.encoder.extension
+        for folder, data in zip(self.folders, encode_images(images, self.encoder)):
+            image_path = self.output_path + folder + filename
+            tmp_path = '{}.{}.tmp'.format(image_path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as fp:
+                    fp.write(data)
+                os.replace(tmp_path, image_path)
+            except Exception:
+                # failed write (e.g. full disk) does not leave its temporary file in output folders
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def close(self) -> None:
+        pass
+
+
+class ShardWriter:
+    # appends samples to tar shards of about shard_size bytes, every shard has a sidecar index of
+    # json lines with member offsets, a sample never spans two shards
+    def __init__(self, path: str, folders: List[str], shard_size: int = 256 * 1024 * 1024, encoder=None,
+                 prefix: str = '') -> None:
+        self.path = path
+        # nodes writing the same folder use different prefixes, so their shards never collide
+        self.prefix = prefix
+        self.components = [get_component(folder) for folder in folders]
+        self.shard_size = shard_size
+        self.encoder = encoder or PngEncoder()
+        self.lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        # existing shards are never appended, new run starts next shard
+        self.shard_number = len([shard for shard in list_shards(path)
+                                 if os.path.basename(shard).startswith('shard-' + prefix)])
+        self.tar = None
+        self.index = None
+
+    def get_shard_path(self) -> str:
+        return os.path.join(self.path, 'shard-{}{:06d}.tar'.format(self.prefix, self.shard_number))
+
+    def open_shard(self) -> None:
+        shard_path = self.get_shard_path()
+        self.tar = tarfile.open(shard_path, 'w', format=tarfile.USTAR_FORMAT)
+        self.index = open(shard_path + '.idx', 'w')
+
+    def close_shard(self) -> None:
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.index.close()
+        self.tar = None
+        self.index = None
+        self.shard_number += 1
+
+    def add_member(self, name: str, data: bytes, mtime: float) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        self.tar.addfile(info, BytesIO(data))
+        # data ends at the current offset minus padding to 512 byte block
+        return self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+    def write(self, name: str, images: list) -> None:
+        key = os.path.splitext(name)[0]
+        encoded = encode_images(images, self.encoder)
+        with self.lock:
+            if self.tar is None:
+                self.open_shard()
+            mtime = time()
+            members = {}
+            for component, data in zip(self.components, encoded):
+                member = '{}.{}{}'.format(key, component, self.encoder.extension)
+                members[component] = [self.add_member(member, data, mtime), len(data)]
+            # index line is written after data, so a crash never leaves index pointing to missing data
+            self.tar.fileobj.flush()
+            self.index.write(json.dumps({'key': key, 'extension': self.encoder.extension,
+                                         'members': members}) + '\n')
+            self.index.flush()
+            if self.tar.offset >= self.shard_size:
+                self.close_shard()
+
+    def close(self) -> None:
+        with self.lock:
+            self.close_shard()
+
+
+def list_shards(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                  if filename.startswith('shard-') and filename.endswith('.tar'))
+
+
+class ShardReader:
+    # random access by key through sidecar indexes, sequential streaming through memory mapped shards
+    def __init__(self, path: str) -> None:
+        self.shards = [shard for shard in list_shards(path) if os.path.isfile(shard + '.idx')]
+        self.samples = {}
+        for shard in self.shards:
+            with open(shard + '.idx') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written last line of interrupted run
+                        continue
+                    self.samples[entry['key']] = (shard, entry.get('extension', '.png'), entry['members'])
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.samples
+
+    def keys(self) -> List[str]:
+        return list(self.samples)
+
+    def get(self, key: str) -> Dict[str, bytes]:
+        shard, _, members = self.samples[key]
+        sample = {}
+        with open(shard, 'rb') as fp:
+            for component, (offset, size) in members.items():
+                fp.seek(offset)
+                sample[component] = fp.read(size)
+        return sample
+
+    def get_image(self, key: str, component: str) -> Union[Image.Image, np.ndarray]:
+        # png and webp are opened with pillow, npy is loaded as BGRA array
+        return decode_image(self.get(key)[component], self.samples[key][1])
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, bytes]]]:
+        # reads shards in write order through mmap, without a read call per member
+        for shard in self.shards:
+            if not os.path.getsize(shard):
+                continue
+            with open(shard + '.idx') as fp:
+                entries = []
+                for line in fp:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+            with open(shard, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                for entry in entries:
+                    yield entry['key'], {component: mm[offset:offset + size]
+                                         for component, (offset, size) in entry['members'].items()}
+
+
+def open_writer(output: str, output_path: str, folders: List[str], shard_size: int = 256 * 1024 * 1024,
+                encoder=None, shard_prefix: str = ''):
+    # output is "folders" or "shards", shards are written to <output_path>/shards/
+    if output == 'shards':
+        return ShardWriter(os.path.join(output_path, 'shards'), folders, shard_size, encoder, shard_prefix)
+    return FolderWriter(output_path, folders, encoder)